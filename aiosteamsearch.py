@@ -28,9 +28,16 @@ import aiohttp
 import operator
 import json
 import math
+import copy
+import time
+import calendar
+import datetime
+from collections import OrderedDict
 import re
 from urllib import parse
 from bs4 import BeautifulSoup
+import steamcache
+from steamcache import Cache
 
 # used to map currency symbols to currency codes
 CURRENCY_MAP = {
@@ -104,15 +111,24 @@ STEAM_KEY = ""  # contains your Steam API key (set using set_key)
 STEAM_CACHE = True  # whether or not steamsearch should cache some results which generally aren't going to change
 STEAM_SESSION = ""  # your Steam Session for SteamCommunityAjax
 STEAM_PRINTING = False  # whether or not steamsearch will occasionally print warnings
+STEAM_LISTING_SOFT_TTL = 300  # seconds a cached store listing is served before it's refreshed in the background
+STEAM_LISTING_HARD_TTL = 3600  # seconds a cached store listing can be served at all before a fetch has to block
+STEAM_ROLLOVER_HOUR = 10  # hour of the day (US Pacific time) the store rolls over its daily, weekly and seasonal deals
+STEAM_REGION_ROLLOVER_HOURS = {}  # country codes whose prices roll over at a different hour of the day (UTC)
+STEAM_APPDETAILS_TTL = 86400  # seconds appdetails without any price data are cached for
+STEAM_APP_CACHE_SIZE = 20000  # most apps (per country) kept in the appdetails and game page caches each
+STEAM_SEARCH_CACHE_SIZE = 5000  # most search terms kept in each cache keyed by them, the least recently used go first
 
 
-def set_key(key, session, cache=True, printing=False):
+def set_key(key, session, cache=True, printing=False, snapshot=None):
     """Used to initiate your key + session strings, also to enable/disable caching
 
     Args:
         key (str): Your Steam API key
         session (str): Your SteamCommunityAjax session, this basically just needs to be any string containing only a-z, A-Z or 0-9
         cache (bool, optional): True to enable caching
+        snapshot (str, optional): path of a cache snapshot to warm the caches from,
+            keep it up to date by scheduling steamcache.registry.snapshot_loop with the same path
     """
     global STEAM_KEY, STEAM_CACHE, STEAM_SESSION, STEAM_PRINTING
     STEAM_KEY = key
@@ -120,14 +136,20 @@ def set_key(key, session, cache=True, printing=False):
     STEAM_CACHE = cache
     STEAM_PRINTING = printing
 
+    if cache and snapshot is not None:
+        loaded = steamcache.registry.load_snapshot(snapshot)
+        if STEAM_PRINTING:
+            print("loaded %s cached results from %s" % (loaded, snapshot))
+
 
 def count_cache():
-    """Counts the amount of cached results
+    """Counts the amount of cached results, see steamcache.registry for a per-cache breakdown
 
     Returns:
         the number of cached results (int)
     """
-    return len(gameid_cache) + len(item_name_cache) + len(userid_cache)
+    return len(gameid_cache) + len(item_name_cache) + len(userid_cache) + len(listing_cache) + \
+        len(game_page_cache) + len(game_search_cache) + len(appdetails_cache)
 
 
 def clear_cache():
@@ -136,11 +158,10 @@ def clear_cache():
     Returns:
         the number of results cleared
     """
-    global gameid_cache, item_name_cache, userid_cache
     items = count_cache()
-    gameid_cache = {}
-    item_name_cache = {}
-    userid_cache = {}
+    for cache in (gameid_cache, item_name_cache, userid_cache, listing_cache,
+                  game_page_cache, game_search_cache, appdetails_cache):
+        cache.clear()
     return items
 
 
@@ -154,6 +175,11 @@ class SteamSessionNotSet(Exception):
     pass
 
 
+class AppDetailsError(Exception):
+    """Exception raised if the appdetails API gives a response which couldn't be understood"""
+    pass
+
+
 def _check_key_set():
     """Internal method to ensure STEAM_KEY has been set before attempting to use it"""
     if not isinstance(STEAM_KEY, str) or STEAM_KEY == "":
@@ -197,6 +223,59 @@ def is_integer(x):
         return False
 
 
+def _pacific_utc_offset(moment):
+    """Internal method returning the UTC offset of US Pacific time, in hours, at a (naive, UTC) datetime"""
+    march = datetime.datetime(moment.year, 3, 8)
+    dst_start = march + datetime.timedelta(days=(6 - march.weekday()) % 7, hours=10)  # second sunday, 2am PST
+    november = datetime.datetime(moment.year, 11, 1)
+    dst_end = november + datetime.timedelta(days=(6 - november.weekday()) % 7, hours=9)  # first sunday, 2am PDT
+    return -7 if dst_start <= moment < dst_end else -8
+
+
+def next_price_rollover(cc="gb", now=None):
+    """Finds when prices in a region are next expected to change
+
+    Args:
+        cc (str, optional): the country code of the region
+        now (float, optional): the unix time to look from, defaults to the current time
+    Returns:
+        float: the unix time of the next rollover
+    """
+    if now is None:
+        now = time.time()
+    midnight = datetime.datetime.utcfromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+    for days in range(3):
+        day = midnight + datetime.timedelta(days=days)
+        if cc in STEAM_REGION_ROLLOVER_HOURS:
+            rollover = day + datetime.timedelta(hours=STEAM_REGION_ROLLOVER_HOURS[cc])
+        else:
+            offset = _pacific_utc_offset(day + datetime.timedelta(hours=12))
+            rollover = day + datetime.timedelta(hours=STEAM_ROLLOVER_HOUR - offset)
+        rollover = calendar.timegm(rollover.utctimetuple())
+        if rollover > now:
+            return rollover
+    return now + 86400
+
+
+def price_ttl(cc="gb", discount_expiration=None, now=None):
+    """Works out how long price-bearing results can be cached for, which is until the next rollover for the region
+    or until the discount on them expires, whichever comes first
+
+    Args:
+        cc (str, optional): the country code the prices are for
+        discount_expiration (int, optional): the unix time the current discount expires, if known
+        now (float, optional): the unix time to look from, defaults to the current time
+    Returns:
+        float: the amount of seconds the results can be cached for
+    """
+    if now is None:
+        now = time.time()
+    expires = next_price_rollover(cc, now)
+    if isinstance(discount_expiration, (int, float)) and now < discount_expiration < expires:
+        expires = discount_expiration
+    return expires - now
+
+
 # link, id, image, title, released, review, reviewLong, discount, price, discountPrice,
 class GamePageResult:
     def __init__(self, link, id, soup):
@@ -252,6 +331,14 @@ class GamePageResult:
             if pricesoup is not None:
                 self.discountPrice = pricesoup.get_text().replace(" ", "").replace("\n", "").replace("\r", "").replace("\t", "").replace("(", "").replace(")", "").replace("-", "")
 
+        # only discounts with a countdown (daily deals, flash sales) give the unix time they end
+        self.discount_expiration = None
+        for scriptsoup in soup.find_all("script"):
+            match = re.search(r"InitDailyDealTimer\(\s*\$DiscountCountdown,\s*(\d+)", scriptsoup.get_text())
+            if match is not None:
+                self.discount_expiration = int(match.group(1))
+                break
+
     @asyncio.coroutine
     def update_price(self, currency, currency_symbol):
         """Attempts to convert the price to GBP
@@ -586,12 +673,9 @@ class SteamSaleResult(TopResult):
 
     @asyncio.coroutine
     def get_title(self, cc="gb", timeout=10):
-        with aiohttp.ClientSession() as session:
-            with aiohttp.Timeout(timeout):
-                resp = yield from session.get("http://store.steampowered.com/api/appdetails/?appids=" + self.id)
-                data = yield from resp.json()
-
-                self.title = parse.unquote(data[self.id]["data"]["name"])
+        data = yield from get_app_details(self.id, cc=cc, timeout=timeout)
+        if data is not None:
+            self.title = parse.unquote(data["name"])
 
 class UserResult:
     """Class containing information about a specific user"""
@@ -975,87 +1059,161 @@ class ItemResult:
                 print("failed to convert currency (" + self.currency + ")")
 
 
+appdetails_cache = Cache("appdetails", max_size=STEAM_APP_CACHE_SIZE)  # caches (appid, cc) to (filters, data) tuples, data is None for unknown apps
+_appdetails_fetches = {}  # in-flight appdetails requests, keyed by (appid, cc, filters)
+
+
+@asyncio.coroutine
+def _fetch_app_details(appid, cc, filters, timeout):
+    """Internal method requesting an app's appdetails and merging them in to appdetails_cache"""
+    with aiohttp.ClientSession() as session:
+        with aiohttp.Timeout(timeout):
+            resp = yield from session.get("http://store.steampowered.com/api/appdetails/?appids=%s&cc=%s&filters=%s"
+                                          % (appid, cc, ",".join(sorted(filters))))
+            json = yield from resp.json()
+
+    if not isinstance(json, dict) or not isinstance(json.get(appid), dict):
+        raise AppDetailsError("unexpected appdetails response for %s" % appid)
+
+    data = None
+    if json[appid].get("success"):
+        # the store sends an empty list rather than a dict when none of the filters matched anything
+        data = json[appid].get("data") or {}
+
+    cached = appdetails_cache.get((appid, cc))
+    if cached is not None and cached[1] is not None and data is not None:
+        filters = filters | cached[0]
+        data = dict(cached[1], **data)
+
+    if STEAM_CACHE:
+        # price_overview doesn't say when a discount ends, so prices are only kept until the next rollover
+        ttl = price_ttl(cc) if "price_overview" in filters else STEAM_APPDETAILS_TTL
+        appdetails_cache.set((appid, cc), (filters, data), ttl=ttl)
+    return data
+
+
+@asyncio.coroutine
+def get_app_details(appid, cc="gb", filters=("basic",), timeout=10):
+    """Gets the data the store's appdetails API has on an app, everything which needs appdetails should go through this
+
+    Only the filters asked for are requested, the parsed data is cached by (appid, cc) and concurrent requests
+    for the same app are merged in to one.
+
+    Args:
+        appid (str): the appid of the app
+        cc (str, optional): the country code to get prices for
+        filters (tuple[str], optional): the appdetails filters needed, e.g. ("basic", "price_overview")
+        timeout (int, optional): how long aiohttp should wait before raising a timeout error
+    Returns:
+        dict: the app's data, or None if the store doesn't know the app
+    """
+    appid = str(appid)
+    filters = frozenset(filters)
+    cached = appdetails_cache.get((appid, cc))
+    if cached is not None and (cached[1] is None or filters <= cached[0]):
+        return cached[1]
+
+    fetch = None
+    for (fetch_appid, fetch_cc, fetch_filters), future in _appdetails_fetches.items():
+        if fetch_appid == appid and fetch_cc == cc and filters <= fetch_filters:
+            fetch = future
+            break
+    if fetch is None:
+        key = (appid, cc, filters)
+        fetch = asyncio.ensure_future(_fetch_app_details(appid, cc, filters, timeout))
+        _appdetails_fetches[key] = fetch
+        fetch.add_done_callback(lambda f: _appdetails_fetches.pop(key, None))
+
+    data = yield from asyncio.shield(fetch)
+    return data
+
+
 @asyncio.coroutine
 def check_game_sales(checks, old, optional_test=None, timeout=120):
     """
 
+    Checks are grouped by (gameid, cc) first, so each pair is fetched once however many watchers it has.
+
     :param checks: a list of tuples (gameid, percent, cc, other)
-    :param old: a dict of games found last time {gameid: percent}
+    :param old: a dict of games found last time {(gameid, cc): percent}
+    :param optional_test: a dict of fake results {gameid or (gameid, cc): (price_overview, name) or None}
     :return: a list of tuples (gameid, check_percent, old_percent, price_overview, name, other)
     """
-    with aiohttp.ClientSession() as session:
-        with aiohttp.Timeout(timeout):
-            cached = optional_test or {}
-            print("useing optional test: %s" % cached)
-            results, new_old = [], {}
+    with aiohttp.Timeout(timeout):
+        optional_test = optional_test or {}
+        print("useing optional test: %s" % optional_test)
+        results, new_old = [], {}
 
-            print("using checks: %s" % str(checks))
+        groups = OrderedDict()
+        for check in checks:
+            groups.setdefault((check[0], check[2]), []).append(check)
+        print("using checks: %d watchers over %d games" % (len(checks), len(groups)))
 
-            for check in checks:
-                try:
-                    if check[0] not in cached:
-                        resp = yield from session.get("http://store.steampowered.com/api/appdetails/?appids=" + check[0] + "&cc=" + check[2])
-                        json = yield from resp.json()
-
-                        if not isinstance(json, dict):
-                            print("failed to find percent for %s" % check[0])
-                            continue
-
-                        if json[check[0]]["success"]:
-                            if "price_overview" not in json[check[0]]["data"]:
-                                cached[check[0]] = None
-                                continue
-                            price_overview = json[check[0]]["data"]["price_overview"]
-                            cached[check[0]] = (price_overview, json[check[0]]["data"]["name"])
-                        else:
-                            cached[check[0]] = None
-
-                        resp.close()
-
-                    if cached[check[0]] is not None:
-                        result = cached[check[0]]
-                        old_percent = float(old.get(check[0], 0))
-                        if (result[0]["discount_percent"] < old_percent and old_percent >= float(check[1])) or (result[0]["discount_percent"] >= float(check[1]) and result[0]["discount_percent"] != old_percent):
-                            results.append([check[0], float(check[1]), old_percent, result[0], result[1]] + list(check[3:]))
-                except:
-                    pass
-            for gameid in cached:
-                if cached[gameid] is not None:
-                    new_old[gameid] = cached[gameid][0]["discount_percent"]
+        for (gameid, cc), group in groups.items():
+            try:
+                if (gameid, cc) in optional_test:
+                    result = optional_test[(gameid, cc)]
+                elif gameid in optional_test:
+                    result = optional_test[gameid]
                 else:
-                    new_old[gameid] = 0
-            return results, new_old
+                    try:
+                        data = yield from get_app_details(gameid, cc=cc, filters=("basic", "price_overview"))
+                    except AppDetailsError:
+                        print("failed to find percent for %s" % gameid)
+                        new_old[(gameid, cc)] = 0
+                        continue
+                    if data is not None and "price_overview" in data:
+                        result = (data["price_overview"], data["name"])
+                    else:
+                        result = None
+
+                if result is None:
+                    new_old[(gameid, cc)] = 0
+                    continue
+                new_percent = result[0]["discount_percent"]
+                new_old[(gameid, cc)] = new_percent
+                old_percent = float(old.get((gameid, cc), 0))
+                for check in group:
+                    if (new_percent < old_percent and old_percent >= float(check[1])) or (new_percent >= float(check[1]) and new_percent != old_percent):
+                        results.append([gameid, float(check[1]), old_percent, result[0], result[1]] + list(check[3:]))
+            except:
+                new_old.setdefault((gameid, cc), 0)
+        return results, new_old
 
 @asyncio.coroutine
 def is_valid_game_id(appid, timeout=10):
     if not isinstance(appid, str):
         return False
-    with aiohttp.ClientSession() as session:
-        with aiohttp.Timeout(timeout):
-            resp = yield from session.get( "http://store.steampowered.com/api/appdetails/?appids=" + appid)
-            json = yield from resp.json()
-
-            return json[appid]["success"]
+    data = yield from get_app_details(appid, timeout=timeout)
+    return data is not None
 
 
 @asyncio.coroutine
 def get_game_name_by_id(appid, timeout=10):
-    with aiohttp.ClientSession() as session:
-        with aiohttp.Timeout(timeout):
-            resp = yield from session.get("http://store.steampowered.com/api/appdetails/?appids=" + appid)
-            data = yield from resp.json()
+    data = yield from get_app_details(appid, timeout=timeout)
+    if data is not None:
+        return parse.unquote(data["name"])
+    return None
+
+game_page_cache = Cache("game_pages", max_size=STEAM_APP_CACHE_SIZE)  # caches (appid, cc) to GamePageResults, until the prices next roll over or the discount ends
 
-            return parse.unquote(data[appid]["data"]["name"])
 
 @asyncio.coroutine
 def get_game_by_id(appid, timeout=10, cc="gb"):
+    cached = game_page_cache.get((appid, cc))
+    if cached is not None:
+        return copy.copy(cached)
+
     with aiohttp.ClientSession() as session:
         with aiohttp.Timeout(timeout):
             resp = yield from session.get("http://store.steampowered.com/app/" + appid + "/?cc=" + cc)
             text = yield from resp.read()
             soup = BeautifulSoup(text, "html.parser")
 
-            return GamePageResult("http://store.steampowered.com/app/" + appid, appid, soup)
+            result = GamePageResult("http://store.steampowered.com/app/" + appid, appid, soup)
+            if STEAM_CACHE:
+                game_page_cache.set((appid, cc), copy.copy(result), ttl=price_ttl(cc, result.discount_expiration))
+            return result
 
 @asyncio.coroutine
 def get_recommendations(appid, timeout=10):
@@ -1097,6 +1255,9 @@ def get_user_level(userid, timeout=10, be_specific=False):
                 return data["response"].get("player_level")
             return None
 
+game_search_cache = Cache("game_searches", max_size=STEAM_SEARCH_CACHE_SIZE)  # caches (term, cc, limit) to lists of GameResults, until the prices next roll over
+
+
 @asyncio.coroutine
 def get_games(term, timeout=10, limit=-1, cc="gb"):
     """Search for a game on steam
@@ -1108,6 +1269,10 @@ def get_games(term, timeout=10, limit=-1, cc="gb"):
     Returns:
         a list of GameResult objects containing the results
     """
+    cached = game_search_cache.get((term, cc, limit))
+    if cached is not None:
+        return [copy.copy(result) for result in cached]
+
     with aiohttp.ClientSession() as session:
         with aiohttp.Timeout(timeout):
 
@@ -1128,9 +1293,72 @@ def get_games(term, timeout=10, limit=-1, cc="gb"):
                     gr = GameResult(x)
                     #yield from gr.update_price(currency, currency_symbol)
                     results.append(gr)
+            # search rows don't say when a discount ends, so the results are only kept until the next rollover
+            if STEAM_CACHE:
+                game_search_cache.set((term, cc, limit), [copy.copy(result) for result in results], ttl=price_ttl(cc))
             return results
 
 
+listing_cache = Cache("listings")  # caches store listing keys to lists of results
+_listing_refreshes = {}  # in-flight store listing fetches, keyed the same as listing_cache
+
+
+def _listing_fetched(key, future):
+    """Internal callback storing the result of a finished store listing fetch"""
+    del _listing_refreshes[key]
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        if STEAM_PRINTING:
+            print("failed to refresh store listing %s: %r" % (key, error))
+    elif STEAM_CACHE:
+        listing_cache.set(key, future.result(), ttl=STEAM_LISTING_HARD_TTL)
+
+
+def _refresh_listing(key, fetch):
+    """Starts fetching a store listing, unless a fetch for the same listing is already running
+
+    Args:
+        key (tuple): the listing_cache key for the listing
+        fetch (callable): returns a coroutine fetching every result for the listing
+    Returns:
+        a future for the listing's results, shared by every caller asking for the same key
+    """
+    if key not in _listing_refreshes:
+        future = asyncio.ensure_future(fetch())
+        _listing_refreshes[key] = future
+        future.add_done_callback(lambda f: _listing_fetched(key, f))
+    return _listing_refreshes[key]
+
+
+@asyncio.coroutine
+def _cached_listing(key, fetch, limit=-1):
+    """Serves a store listing from listing_cache, only blocking on a fetch once the entry is past its hard TTL
+
+    Entries older than STEAM_LISTING_SOFT_TTL are still returned immediately but are refreshed in the background.
+
+    Args:
+        key (tuple): the listing_cache key for the listing
+        fetch (callable): returns a coroutine fetching every result for the listing
+        limit (int, optional): how many results to return, 0 or less returns every result
+    Returns:
+        a list of copies of the cached results
+    """
+    # one lookup for both, as the entry could expire between separate get and age calls
+    entry = listing_cache.get_entry(key)
+    if entry is None or not STEAM_CACHE:
+        results = yield from asyncio.shield(_refresh_listing(key, fetch))
+    else:
+        results, age = entry
+        if age >= STEAM_LISTING_SOFT_TTL:
+            _refresh_listing(key, fetch)
+
+    if limit > 0:
+        results = results[:limit]
+    return [copy.copy(result) for result in results]
+
+
 @asyncio.coroutine
 def category_search(link, timeout=10, limit=-1, cc="gb"):
     with aiohttp.ClientSession() as session:
@@ -1153,8 +1381,10 @@ def top_search(*args, **kwargs):
     return result
 
 @asyncio.coroutine
-def upcoming_search(*args, **kwargs):
-    result = yield from category_search("search/?filter=comingsoon", *args, **kwargs)
+def upcoming_search(timeout=10, limit=-1, cc="gb"):
+    result = yield from _cached_listing(("upcoming_search", cc),
+                                        lambda: category_search("search/?filter=comingsoon", timeout=timeout, cc=cc),
+                                        limit=limit)
     return result
 
 @asyncio.coroutine
@@ -1164,6 +1394,11 @@ def specials_search(*args, **kwargs):
 
 @asyncio.coroutine
 def new_search(timeout=10, limit=-1, cc="gb"):
+    result = yield from _cached_listing(("new_search", cc), lambda: _fetch_new_search(timeout, cc), limit=limit)
+    return result
+
+@asyncio.coroutine
+def _fetch_new_search(timeout, cc):
     with aiohttp.ClientSession() as session:
         with aiohttp.Timeout(timeout):
             resp = yield from session.get("http://store.steampowered.com/explore/new/?cc=%s" % cc)
@@ -1174,8 +1409,6 @@ def new_search(timeout=10, limit=-1, cc="gb"):
             subsoups = soup.find_all("a", {"class": "tab_item"})
             for subsoup in subsoups:
                 results.append(NewCategoryResult(subsoup))
-                if 0 < limit <= len(results):
-                    break
 
             return results
 
@@ -1223,6 +1456,12 @@ def top_sellers(timeout=60, limit=-1, cc="gb"):
         limit (int, optional): how many results it should return, 0 or less returns every result found
     Returns:
         a list of TopResult objects"""
+    result = yield from _cached_listing(("top_sellers", cc), lambda: _fetch_top_sellers(timeout, cc), limit=limit)
+    return result
+
+
+@asyncio.coroutine
+def _fetch_top_sellers(timeout, cc):
     with aiohttp.ClientSession() as session:
         with aiohttp.Timeout(timeout):
             resp = yield from session.get("http://store.steampowered.com/?cc=" + cc)
@@ -1232,17 +1471,12 @@ def top_sellers(timeout=60, limit=-1, cc="gb"):
             subsoup = soup.find("div", {"id": "tab_topsellers_content"})
             rawResults = subsoup.findAll("a", recursive=False)
             results = []
-            n = 0
             for x in rawResults:
-                if n >= limit > 0:
-                    break
-
                 cls = x.get("class")
                 if cls is not None and "tab_item" in cls:
                 #if cls is not None and "sale_capsule" in cls:
                     tr = TopResult(x)
                     results.append(tr)
-                    n += 1
                     #try:
                     #    tr = SteamSaleResult(x)
                     #    yield from tr.get_title(cc=cc, timeout=timeout)
@@ -1342,6 +1576,12 @@ def specials(timeout=10, limit=-1, cc="gb"):
         limit (int, optional): how many results it should return, 0 or less returns every result found
     Returns:
         a list of TopResult objects"""
+    result = yield from _cached_listing(("specials", cc), lambda: _fetch_specials(timeout, cc), limit=limit)
+    return result
+
+
+@asyncio.coroutine
+def _fetch_specials(timeout, cc):
     with aiohttp.ClientSession() as session:
         with aiohttp.Timeout(timeout):
             resp = yield from session.get("http://store.steampowered.com/?cc=" + cc)
@@ -1351,16 +1591,12 @@ def specials(timeout=10, limit=-1, cc="gb"):
             subsoup = soup.find("div", {"id": "tab_specials_content"})
             rawResults = subsoup.findAll("a", recursive=False)
             results = []
-            n = 0
             for x in rawResults:
-                if n >= limit > 0:
-                    break
                 cls = x.get("class")
                 if cls is not None and "tab_item" in cls:
                     tr = TopResult(x)
                     #yield from tr.update_price(currency, currency_symbol)
                     results.append(tr)
-                    n += 1
             return results
 
 
@@ -1414,7 +1650,7 @@ def get_user_library(steamid, timeout=10, be_specific=False):
     return None
 
 
-userid_cache = {}  # caches search terms to steamids
+userid_cache = Cache("userids", max_size=STEAM_SEARCH_CACHE_SIZE)  # caches search terms to steamids
 
 
 @asyncio.coroutine
@@ -1427,8 +1663,9 @@ def get_user_id(name, timeout=10):
     Returns:
         either None or a steamid (str) if a vanity url matching that name is found
         """
-    if name in userid_cache:
-        return userid_cache[name]
+    cached = userid_cache.get(name)
+    if cached is not None:
+        return cached
     else:
         _check_key_set()
         with aiohttp.ClientSession() as session:
@@ -1455,8 +1692,9 @@ def search_for_userid(username, timeout=10, be_specific=False):
     Returns:
         A steamid (str)
         """
-    if username in userid_cache:
-        return userid_cache[username]
+    cached = userid_cache.get(username)
+    if cached is not None:
+        return cached
     else:
         if be_specific:
             uid = yield from get_user_id(username, timeout=timeout)
@@ -1548,7 +1786,7 @@ def get_item(appid, item_name, timeout=10, currency="GBP", currency_symbol="£")
                     return result
 
 
-gameid_cache = {}  # caches search terms to (appid, appname) tuples
+gameid_cache = Cache("gameids", max_size=STEAM_SEARCH_CACHE_SIZE)  # caches search terms to (appid, appname) tuples
 
 
 @asyncio.coroutine
@@ -1561,8 +1799,9 @@ def get_app(name, timeout=10):
     Returns:
         A tuple containing (appid (str), apptitle (str))
         """
-    if name in gameid_cache:
-        return gameid_cache[name]
+    cached = gameid_cache.get(name)
+    if cached is not None:
+        return cached
     else:
         dat = yield from get_games(name, limit=1, timeout=timeout)
         if len(dat) > 0:
@@ -1573,7 +1812,7 @@ def get_app(name, timeout=10):
             return None, None
 
 
-item_name_cache = {}  # caches search terms to item url names
+item_name_cache = Cache("item_names", max_size=STEAM_SEARCH_CACHE_SIZE)  # caches search terms to item url names
 
 
 @asyncio.coroutine
@@ -1588,8 +1827,9 @@ def get_item_name(name, appid, timeout=10):
         the item name (str) or None if no item could be found
         """
     cache_name = appid + "::" + name
-    if cache_name in item_name_cache:
-        return item_name_cache[cache_name]
+    cached = item_name_cache.get(cache_name)
+    if cached is not None:
+        return cached
     else:
         with aiohttp.ClientSession() as session:
             with aiohttp.Timeout(timeout):
@@ -1710,6 +1950,13 @@ def top_game_playercounts(limit=10, timeout=10):
     Returns:
         A list of tuples in the format (current_players (str), peak_players (str), game_name (str), game_link (str))
         """
+    result = yield from _cached_listing(("top_game_playercounts",), lambda: _fetch_top_game_playercounts(timeout),
+                                        limit=limit)
+    return result
+
+
+@asyncio.coroutine
+def _fetch_top_game_playercounts(timeout):
     with aiohttp.ClientSession() as session:
         with aiohttp.Timeout(timeout):
             resp = yield from session.get("http://store.steampowered.com/stats")
@@ -1727,8 +1974,6 @@ def top_game_playercounts(limit=10, timeout=10):
                     current_players = stuff[0].get_text()
                     peak_players = stuff[1].get_text()
                     stats.append((current_players, peak_players, name, link))
-                    if len(stats) >= limit > 0:
-                        break
             return stats
 
 @asyncio.coroutine
@@ -0,0 +1,226 @@
+"""Counts the redis round trips the per-message lookups make, comparing an old revision with the working tree
+
+Each revision runs in its own process against an empty local test database (db 15 by default), seeded with the
+keys the old code wrote and migrated to the current layout where the revision has migrations. Every redis client
+the code creates is wrapped in a proxy counting its calls, with a pipeline execute or script call counting as one.
+
+    python benchmarks/redis_round_trips.py [--old REF] [--db N]
+
+REF defaults to the root commit. Needs redis running locally and the bot's dependencies (discord.py) installed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import types
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+USERID = "100"
+CHANNELID = "200"
+SERVERID = "300"
+COMMAND = "search"
+
+# the keys as the code before the migrations wrote them
+LEGACY_KEYS = {
+    "prefixes::server::" + SERVERID: "!",
+    "languages::" + USERID: "english",
+    "currencies::code::" + USERID: "USD",
+    "currencies::symbol::" + USERID: "$",
+    "countries::" + USERID: "us",
+    "names::" + USERID: "someone",
+    "marks::" + USERID: "true",
+    "global_bans::server::" + SERVERID: "other;commands",
+    "permissions::" + COMMAND + "::server::" + SERVERID + "::length": "2",
+    "permissions::" + COMMAND + "::server::" + SERVERID + "::0": "send_messages",
+    "permissions::" + COMMAND + "::server::" + SERVERID + "::1": "embed_links",
+}
+
+
+class CountingRedis:
+    """Wraps a redis client, counting every call, pipeline execute and script call as one round trip"""
+    clients = []
+
+    def __init__(self, client):
+        # not called client, so nothing mistakes the proxy for a wrapper it should unwrap and skip the counting
+        self.counted = client
+        self.calls = 0
+        CountingRedis.clients.append(self)
+
+    def pipeline(self, *args, **kwargs):
+        return CountingPipeline(self.counted.pipeline(*args, **kwargs), self)
+
+    def register_script(self, script):
+        registered = self.counted.register_script(script)
+
+        def call(keys=[], args=[], client=None):
+            if isinstance(client, CountingPipeline):
+                return registered(keys=keys, args=args, client=client.pipe)
+            self.calls += 1
+            return registered(keys=keys, args=args, client=client)
+        return call
+
+    def __getattr__(self, name):
+        attr = getattr(self.counted, name)
+        if not callable(attr) or name in ("pubsub", "scan_iter"):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return attr(*args, **kwargs)
+        return counted
+
+    @classmethod
+    def total(cls):
+        return sum(client.calls for client in cls.clients)
+
+    @classmethod
+    def reset(cls):
+        for client in cls.clients:
+            client.calls = 0
+
+
+class CountingPipeline:
+    def __init__(self, pipe, redis):
+        self.pipe = pipe
+        self.redis = redis
+
+    def execute(self, *args, **kwargs):
+        self.redis.calls += 1
+        return self.pipe.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+
+def measure(tree, db):
+    """Runs the lookups with the code in tree, returning {lookup: (cold, warm, error)}. Cold is a new message with
+    every local cache empty, warm is the next new message"""
+    import redis
+    real_redis = redis.StrictRedis
+    seed = real_redis(host="localhost", port=6379, db=db)
+    if seed.dbsize() > 0:
+        raise SystemExit("redis database %d isn't empty" % db)
+    # the collection always connects to db 0, so point every client at the test database instead
+    redis.StrictRedis = lambda *args, **kwargs: CountingRedis(real_redis(*args, **dict(kwargs, db=db)))
+
+    sys.path.insert(0, tree)
+    import discord
+    import steamctx
+    import steamredis
+
+    class Channel(discord.Channel):
+        def __init__(self, id, server):
+            self.id = id
+            self.server = server
+
+        def permissions_for(self, member):
+            return discord.Permissions.all()
+
+    server = types.SimpleNamespace(id=SERVERID)
+    author = types.SimpleNamespace(id=USERID, roles=[])
+    message = types.SimpleNamespace(author=author, channel=Channel(CHANNELID, server), server=server, mentions=[])
+    sdata = types.SimpleNamespace(languages={"english": "english"})
+
+    try:
+        seed.mset(LEGACY_KEYS)
+        sredis = steamredis.RedisCollection(None, None, sdata)
+        if hasattr(sredis, "migrations"):
+            sredis.migrations.run()
+
+        def reset_caches():
+            steamcache = sys.modules.get("steamcache")
+            if steamcache is not None:
+                for cache in steamcache.registry.caches.values():
+                    cache.clear()
+            if hasattr(sredis.banned, "index"):
+                sredis.banned.index = None
+
+        def check_ban(ctx):
+            try:
+                sredis.banned.check_ban(ctx, message, COMMAND)
+            except (steamredis.BannedError, steamredis.CommandPermissionError):
+                pass
+
+        lookups = [
+            ("get_prefix", lambda ctx: ctx.get_prefix("steam ")),
+            ("check_ban", check_ban),
+            ("get_language", lambda ctx: sredis.languages.get_language(USERID, SERVERID)),
+            ("get_currency", lambda ctx: sredis.currency.get_currency(USERID)),
+            ("get_saved_name", lambda ctx: sredis.names.get_saved_name(ctx, "", False)),
+        ]
+        if hasattr(steamctx.Context, "prefetch"):
+            # what a message costs in total when everything it needs is read up front
+            each = list(lookups)
+
+            def prefetched(ctx):
+                ctx.prefetch(COMMAND)
+                for _, lookup in each:
+                    lookup(ctx)
+            lookups.append(("prefetch + all", prefetched))
+
+        results = {}
+        for name, lookup in lookups:
+            reset_caches()
+            counts = []
+            error = None
+            for _ in range(2):
+                ctx = steamctx.Context(None, None, sdata, sredis).set(message)
+                CountingRedis.reset()
+                try:
+                    lookup(ctx)
+                except Exception as e:
+                    # the old code has bugs on some of these paths, so report how far it got
+                    error = type(e).__name__
+                counts.append(CountingRedis.total())
+            results[name] = (counts[0], counts[1], error)
+        return results
+    finally:
+        seed.flushdb()
+
+
+def run_tree(tree, db):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--tree", tree, "--db", str(db)],
+                                     cwd=tree)
+    return json.loads(output.decode("utf-8").splitlines()[-1])
+
+
+def export_ref(ref, path):
+    archive = subprocess.check_output(["git", "archive", ref], cwd=REPO)
+    subprocess.run(["tar", "-x", "-C", path], input=archive, check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares redis round trips per lookup between two revisions")
+    parser.add_argument("--old", help="the git revision to compare against, defaults to the root commit")
+    parser.add_argument("--db", type=int, default=15, help="an empty local redis database to run in")
+    parser.add_argument("--tree", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.tree is not None:
+        print(json.dumps(measure(args.tree, args.db)))
+        return
+
+    old_ref = args.old or subprocess.check_output(["git", "rev-list", "--max-parents=0", "HEAD"],
+                                                  cwd=REPO).decode("utf-8").split()[0]
+    with tempfile.TemporaryDirectory() as old_tree:
+        export_ref(old_ref, old_tree)
+        old = run_tree(old_tree, args.db)
+    new = run_tree(REPO, args.db)
+
+    print("%-16s %8s %8s %8s  %s" % ("lookup", "old", "new", "new warm", "notes"))
+    for name in new:
+        old_counts = old.get(name)
+        notes = []
+        if old_counts is not None and old_counts[2] is not None:
+            notes.append("old raised " + old_counts[2])
+        if new[name][2] is not None:
+            notes.append("new raised " + new[name][2])
+        print("%-16s %8s %8d %8d  %s" % (name, old_counts[0] if old_counts is not None else "-", new[name][0],
+                                         new[name][1], ", ".join(notes)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+from steambotplugin import plugin, check
+import asyncio
+import steamaudit
+import steamcache
+import steamredis
+
+
+@check(lambda ctx, args: ctx.message.author.id in ctx.sdata.owners)
+@plugin("steam cachestats", 5)
+@asyncio.coroutine
+def cachestats(ctx, *spl):
+    yield from ctx.say("```prolog\n" + "\n".join(steamcache.registry.report()) + "\n```")
+
+
+@check(lambda ctx, args: ctx.message.author.id in ctx.sdata.owners)
+@plugin("steam redisstats", 5)
+@asyncio.coroutine
+def redisstats(ctx, *spl):
+    by = tuple(field for field in spl[2:] if field in ("helper", "command", "op")) or ("helper", "command")
+    # as many whole rows as fit in one message, the report is sorted so the slowest in total come first
+    lines = []
+    length = 0
+    for line in steamredis.stats.report(by):
+        length += len(line) + 1
+        if length > 1980:
+            break
+        lines.append(line)
+    yield from ctx.say("```prolog\n" + "\n".join(lines) + "\n```")
+
+
+@check(lambda ctx, args: ctx.message.author.id in ctx.sdata.owners)
+@plugin("steam migrate [run]", 5)
+@asyncio.coroutine
+def migrate(ctx, *spl):
+    migrations = ctx.sredis.migrations
+    if len(spl) > 2 and spl[2] == "run":
+        version = yield from ctx.sredis.run_async(migrations.run)
+        if version is None:
+            yield from ctx.say("another shard is already running the migrations")
+        else:
+            yield from ctx.say("schema version is now %d" % version)
+        return
+    report = yield from ctx.sredis.run_async(migrations.dry_run)
+    lines = ["%-8s %8s %10s  %s" % ("version", "keys", "bytes", "migration")]
+    lines += ["%-8d %8d %10d  %s" % (item["version"], item["keys"], item["bytes"], item["description"]) for item in report]
+    yield from ctx.say("```prolog\n" + "\n".join(lines) + "\n```")
+
+
+@check(lambda ctx, args: ctx.message.author.id in ctx.sdata.owners)
+@plugin("steam redisaudit", 60)
+@asyncio.coroutine
+def redisaudit(ctx, *spl):
+    yield from ctx.client.send_typing(ctx.message.channel)
+    results = yield from ctx.sredis.run_async(ctx.sredis.audit)
+    yield from ctx.say("```prolog\n" + "\n".join(steamaudit.report(results))[:1980] + "\n```")
+
+
+@check(lambda ctx, args: ctx.message.author.id in ctx.sdata.owners)
+@plugin("steam watcherstats", 5)
+@asyncio.coroutine
+def watcherstats(ctx, *spl):
+    stats = ctx.sredis.watcher_scheduler.stats()
+    stats["sent"] = ctx.sredis.watcher.notifications.sent
+    stats["failed"] = ctx.sredis.watcher.notifications.failed
+    yield from ctx.say("```prolog\n" + "\n".join("%-12s %s" % (name, value if isinstance(value, int) else "%.2f" % value)
+                                                   for name, value in stats.items()) + "\n```")
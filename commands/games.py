@@ -11,22 +11,23 @@ def game(ctx, *spl):
     ctx.cooldown(ctx.message.author.id, "game")
     yield from ctx.client.send_typing(ctx.message.channel)
     term = " ".join(spl[2:])
+    cc = ctx.sredis.country.get_country(ctx.message.author.id, ctx)
     result = None
     if ctx.marked:
         term = term.lower().replace("-", " ").replace(":", "")
         if ctx.steamsearch.is_integer(term):
-            result = yield from ctx.steamsearch.get_game_by_id(term, cc=ctx.sredis.country.get_country(ctx.message.author.id))
+            result = yield from ctx.steamsearch.get_game_by_id(term, cc=cc)
             if result is not None and result.title == "???":
                 result = None
         else:
-            results = yield from ctx.steamsearch.get_games(term, limit=20, cc=ctx.sredis.country.get_country(ctx.message.author.id))
+            results = yield from ctx.steamsearch.get_games(term, limit=20, cc=cc)
             result = None
             for game in results:
                 if game.title.lower().replace("-", " ").replace(":", "") == term:
                     result = game
                     break
     else:
-        results = yield from ctx.steamsearch.get_games(term, limit=1, cc=ctx.sredis.country.get_country(ctx.message.author.id))
+        results = yield from ctx.steamsearch.get_games(term, limit=1, cc=cc)
         if len(results) > 0:
             result = results[0]
 
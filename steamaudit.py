@@ -0,0 +1,140 @@
+import heapq
+import redis
+
+AUDIT_SAMPLE_RATE = 10  # MEMORY USAGE is run on one key in this many, the rest are estimated from them
+AUDIT_LARGEST = 10  # how many of the largest sampled keys to report per namespace
+AUDIT_EXAMPLES = 5  # how many suspected orphans to list per namespace
+
+
+def key_bytes(client, key):
+    """Gets the memory used by a key with MEMORY USAGE, falling back to the length of string values on redis
+    versions before 4 (and 0 for anything else)"""
+    try:
+        size = client.execute_command("MEMORY", "USAGE", key)
+    except redis.ResponseError:
+        try:
+            size = client.strlen(key)
+        except redis.ResponseError:
+            size = 0
+    return int(size or 0)
+
+
+def _orphaned_permission_indexes(client, keys):
+    # old indexed permission lists: key::n is orphaned if key::length is gone or no longer covers n
+    indexes = []
+    for key in keys:
+        parts = key.decode("utf-8").split("::")
+        if len(parts) >= 5 and parts[-3] in ("server", "channel") and parts[-1].isdigit():
+            indexes.append((key, "::".join(parts[:-1]) + "::length", int(parts[-1])))
+    if len(indexes) == 0:
+        return []
+    lengths = client.mget([length_key for _, length_key, _ in indexes])
+    return [key for (key, _, index), length in zip(indexes, lengths) if length is None or int(length) <= index]
+
+
+def _orphaned_prefixes(client, keys):
+    # prefixes set back to the default used to be written rather than deleted
+    values = client.mget(keys)
+    return [key for key, value in zip(keys, values) if value in (b"", b"steam ")]
+
+
+def _orphaned_bans(client, keys):
+    # ban sets which aren't in the index (so the local filter never checks them)
+    sets = [key for key in keys if key.endswith(b"::set") and not key.endswith(b"::index::set")]
+    if len(sets) == 0:
+        return []
+    pipe = client.pipeline(transaction=False)
+    for key in sets:
+        pipe.sismember("global_bans::index::set", key[len(b"global_bans::"):-len(b"::set")])
+    return [key for key, indexed in zip(sets, pipe.execute()) if not indexed]
+
+
+# namespace -> function(client, keys) giving the keys of a SCAN batch which look orphaned
+ORPHAN_CHECKS = {
+    "permissions": _orphaned_permission_indexes,
+    "prefixes": _orphaned_prefixes,
+    "global_bans": _orphaned_bans,
+}
+
+
+def audit_namespace(client, namespace, batch_size=500, sample_rate=AUDIT_SAMPLE_RATE):
+    """SCANs every key in a namespace, sampling their memory usage and looking for orphans
+
+    Returns:
+        a dict containing namespace, keys, sampled, bytes (estimated from the sampled keys), largest (a list of
+        (bytes, key) of the largest sampled keys), orphans (the number suspected) and orphan_examples
+    """
+    keys = 0
+    sampled = 0
+    sampled_bytes = 0
+    largest = []
+    orphans = 0
+    examples = []
+    check = ORPHAN_CHECKS.get(namespace)
+
+    cursor = 0
+    while True:
+        cursor, batch = client.scan(cursor, match=namespace + "::*", count=batch_size)
+        for key in batch:
+            if keys % sample_rate == 0:
+                size = key_bytes(client, key)
+                sampled += 1
+                sampled_bytes += size
+                heapq.heappush(largest, (size, key.decode("utf-8")))
+                if len(largest) > AUDIT_LARGEST:
+                    heapq.heappop(largest)
+            keys += 1
+        if check is not None and len(batch) > 0:
+            orphaned = check(client, batch)
+            orphans += len(orphaned)
+            examples += [key.decode("utf-8") for key in orphaned[:AUDIT_EXAMPLES - len(examples)]]
+        if int(cursor) == 0:
+            break
+
+    return {
+        "namespace": namespace,
+        "keys": keys,
+        "sampled": sampled,
+        "bytes": int(sampled_bytes * keys / sampled) if sampled > 0 else 0,
+        "largest": sorted(largest, reverse=True),
+        "orphans": orphans,
+        "orphan_examples": examples
+    }
+
+
+def audit_keyspace(client, namespaces, batch_size=500, sample_rate=AUDIT_SAMPLE_RATE):
+    """Audits every namespace, plus the keys which aren't in any of them (reported under the namespace None,
+    without sampling, as they're most likely left over from removed features)
+
+    Returns:
+        a list of audit_namespace results, largest first
+    """
+    results = [audit_namespace(client, namespace, batch_size, sample_rate) for namespace in namespaces]
+    prefixes = tuple(namespace.encode("utf-8") + b"::" for namespace in namespaces)
+    unknown = 0
+    examples = []
+    for key in client.scan_iter(count=batch_size):
+        if not key.startswith(prefixes):
+            unknown += 1
+            if len(examples) < AUDIT_EXAMPLES:
+                examples.append(key.decode("utf-8"))
+    results.sort(key=lambda result: -result["bytes"])
+    results.append({"namespace": None, "keys": unknown, "sampled": 0, "bytes": 0, "largest": [],
+                    "orphans": unknown, "orphan_examples": examples})
+    return results
+
+
+def report(results):
+    """Formats audit_keyspace results in to lines of a table followed by the largest keys and orphan examples"""
+    lines = ["%-16s %8s %12s %8s" % ("namespace", "keys", "~bytes", "orphans")]
+    for result in results:
+        lines.append("%-16s %8d %12d %8d" % (result["namespace"] or "(none)", result["keys"], result["bytes"],
+                                             result["orphans"]))
+    for result in results:
+        if len(result["largest"]) > 0:
+            lines.append("")
+            lines.append("largest %s: %s" % (result["namespace"],
+                                             ", ".join("%s (%d)" % (key, size) for size, key in result["largest"][:3])))
+        if len(result["orphan_examples"]) > 0:
+            lines.append("orphans %s: %s" % (result["namespace"] or "(none)", ", ".join(result["orphan_examples"])))
+    return lines
@@ -15,16 +15,25 @@ Context object:
         sdata           - hub for per-session steambot data (SteamData object)
         client          - the steam client
         marked          - whether or not the command was marked (steam game vs steam *game)
+        prefetched      - the redis values read by prefetch for this message
+        command         - the command name redis calls are being tagged with, or None
 
 
     Function Attributes:
 
         format(message, include_head=True)      - sets the formatting, this is already called for the plugin
+        prefetch(key=None)                      - reads all the redis state this message may need in one round trip,
+                                                  helper functions given ctx=ctx read from it instead of redis
+        prefetch_async(key=None)                - prefetch without blocking the event loop, coroutine
+        set_command(name)                       - tags the redis calls made for this message with the command name,
+                                                  see steamredis.stats (prefetch does this when given a key)
         get_prefix(default)                     - returns the prefix for this context, or the given default if none found
+        get_prefix_async(default)               - get_prefix without blocking the event loop, coroutine
         set_prefix(prefix, server_prefix=True)  - sets the prefix for this context
         get_all_permissions(key)                - get the required permissions for a given command
         check_permissions(key)                  - check if the user for this context has permission to use that command
         is_premium()                            - returns true or false depending on if the user for this context is premium
+        get_lang_async()                        - returns the Language object without blocking the event loop, coroutine
         say(message, dest=None)                 - sends a "safe" message to this context, coroutine
         typing(dest=None)                       - just client.send_typing(dest or ctx.channel)
 
@@ -40,6 +49,8 @@ Language object:
         get_error(name, join=True)     - gets an error under "name"
         get_exception(name, join=True) - gets an exception under "name"
 
+    Languages are held in memory (falling back to english for missing strings), so these never touch redis.
+
 
 
 SteamData object:
@@ -53,6 +64,7 @@ SteamData object:
         last_save               - the time of the last "save" (the bot does quite a few things during this save)
         valid_commands          - list of all registered commands
         cooldown_whitelist      - list of users exempt from cooldowns
+        owners                  - list of users allowed to use the bot-owner commands
         commands_count          - meant to be the number of commands used in this session (unreliable)
         start_time              - the time the bot started
         languages               - a dict containing all the languages
@@ -86,6 +98,24 @@ RedisCollection object:
         recommendations - contains helper functions for the recommendations db (RecommendationRedis object)
         query           - contains helper functions for the query db (QueryRedis object)
         shard_tracker   - contains helper functions for the shard_tracker db (ShardTrackerRedis object)
+        prefixes        - contains helper functions for the prefixes db, cached locally (PrefixRedis object)
+        settings        - contains helper functions for the per-user settings hash used by languages, currency,
+                          country, names and marked, cached locally (UserSettingsRedis object)
+        watcher_scheduler - spreads the watcher checks over time, schedule watcher_scheduler.run() once on the loop
+                            (WatcherScheduler object)
+        migrations      - runs the helpers' key schema migrations, call migrations.run() through run_async at
+                          startup (steammigrations.MigrationRunner object)
+
+    Function Attributes:
+
+        run_async(func, *args, **kwargs) - runs a blocking function (e.g. a helper method) off the event loop, coroutine
+        namespaces()                     - returns the names of every helper's RedisHandler (their key prefixes)
+        audit()                          - reports the key counts, memory and suspected orphans of each namespace
+        subscribe(channel, callback)     - calls callback(data) on the event loop for every message published to channel
+        publish(channel, data)           - publishes data to every shard subscribed to channel
+
+    Every helper function talks to redis synchronously, which blocks the event loop. From a coroutine either use
+    helper.run_async(method_name, *args) or the *_async variants (e.g. banned.check_ban_async, languages.get_language_async).
 
 """
 
@@ -0,0 +1,318 @@
+import asyncio
+import os
+import pickle
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+# upper bounds (in seconds) of the age buckets reported by Cache.stats
+AGE_BUCKETS = ((60, "<1m"), (600, "<10m"), (3600, "<1h"), (86400, "<1d"))
+
+SNAPSHOT_VERSION = 1  # bumped whenever the snapshot layout changes, older snapshots are ignored
+
+
+def approximate_size(obj, _seen=None):
+    """Roughly estimates the memory used by an object, following containers and instance attributes
+
+    Args:
+        obj: the object to measure
+    Returns:
+        the approximate size in bytes (int)
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approximate_size(k, _seen) + approximate_size(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(x, _seen) for x in obj)
+    elif hasattr(obj, "__dict__"):
+        size += approximate_size(obj.__dict__, _seen)
+    return size
+
+
+class Cache:
+    """An in-process cache which keeps track of its own usage so it can be inspected through the registry.
+    It's safe to use from executor threads as well as the event loop.
+
+    Args:
+        name (str): the name the cache is registered under
+        max_size (int, optional): the most entries to keep before evicting the least recently used, 0 or less for no limit
+        ttl (float, optional): the default amount of seconds entries live for, None for forever
+        register (bool, optional): whether to add the cache to the module registry
+        persist (bool, optional): whether registry snapshots include the cache, turn it off for caches kept in step
+            by invalidations which would be missed while the process is down
+    """
+    def __init__(self, name, max_size=0, ttl=None, register=True, persist=True):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist = persist
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._entries = OrderedDict()  # key -> (value, stored_at, expires_at)
+        self._lock = threading.RLock()
+        if register:
+            registry.register(self)
+
+    def _live_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.time():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        """Gets a value from the cache, counting the lookup as a hit or a miss
+
+        Returns:
+            the cached value, or default if it isn't cached or has expired
+        """
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            if self.max_size > 0:
+                self._entries.move_to_end(key)
+            return entry[0]
+
+    def get_entry(self, key):
+        """Gets a value along with how many seconds ago it was stored, in one lookup counted like get
+
+        Returns:
+            a (value, age) tuple, or None if it isn't cached or has expired
+        """
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.max_size > 0:
+                self._entries.move_to_end(key)
+        return entry[0], time.time() - entry[1]
+
+    def set(self, key, value, ttl=None):
+        """Stores a value in the cache
+
+        Args:
+            ttl (float, optional): seconds the value lives for, defaults to the cache's ttl
+        """
+        if ttl is None:
+            ttl = self.ttl
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (value, now, now + ttl if ttl is not None else None)
+            self._entries.move_to_end(key)
+            while 0 < self.max_size < len(self._entries):
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def age(self, key):
+        """Returns how many seconds ago a key was stored, or None if it isn't cached"""
+        with self._lock:
+            entry = self._live_entry(key)
+        if entry is None:
+            return None
+        return time.time() - entry[1]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def dump(self):
+        """Returns every live entry as a list of (key, value, stored_at, expires_at) tuples"""
+        now = time.time()
+        with self._lock:
+            return [(key, value, stored_at, expires_at) for key, (value, stored_at, expires_at) in self._entries.items()
+                    if expires_at is None or expires_at > now]
+
+    def load(self, entries):
+        """Adds entries produced by dump, skipping any that have expired since
+
+        Returns:
+            the number of entries loaded (int)
+        """
+        now = time.time()
+        loaded = 0
+        with self._lock:
+            for key, value, stored_at, expires_at in entries:
+                if expires_at is None or expires_at > now:
+                    self._entries[key] = (value, stored_at, expires_at)
+                    loaded += 1
+            while 0 < self.max_size < len(self._entries):
+                self._entries.popitem(last=False)
+        return loaded
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._live_entry(key) is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._live_entry(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Gets the usage statistics for this cache
+
+        Returns:
+            a dict containing entries, bytes, hits, misses, hit_ratio, evictions, expirations and ages,
+            where ages maps each AGE_BUCKETS label (plus ">=1d") to the number of entries in it
+        """
+        now = time.time()
+        ages = OrderedDict((label, 0) for _, label in AGE_BUCKETS)
+        ages[">=1d"] = 0
+        with self._lock:
+            entries = list(self._entries.values())
+        for value, stored_at, expires_at in entries:
+            age = now - stored_at
+            for limit, label in AGE_BUCKETS:
+                if age < limit:
+                    ages[label] += 1
+                    break
+            else:
+                ages[">=1d"] += 1
+
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(entries),
+            "bytes": approximate_size(entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups > 0 else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "ages": ages
+        }
+
+
+class CacheRegistry:
+    """Keeps track of every Cache so they can be inspected together"""
+    def __init__(self):
+        self.caches = OrderedDict()
+
+    def register(self, cache):
+        self.caches[cache.name] = cache
+        return cache
+
+    def unregister(self, name):
+        return self.caches.pop(name, None)
+
+    def stats(self):
+        """Returns a dict mapping each cache name to its Cache.stats()"""
+        return OrderedDict((name, cache.stats()) for name, cache in self.caches.items())
+
+    def report(self):
+        """Formats the stats of every cache in to lines of a table
+
+        Returns:
+            list[str]: the rows of the table, starting with a header
+        """
+        lines = ["%-20s %8s %10s %6s %9s  %s" % ("cache", "entries", "bytes", "hit%", "evictions", "ages")]
+        for name, stats in self.stats().items():
+            ages = " ".join("%s:%s" % (label, count) for label, count in stats["ages"].items() if count > 0)
+            lines.append("%-20s %8d %10d %6.1f %9d  %s" % (name, stats["entries"], stats["bytes"],
+                                                          stats["hit_ratio"] * 100, stats["evictions"], ages or "-"))
+        return lines
+
+    def save_snapshot(self, path):
+        """Writes every registered cache (except those with persist off) to a snapshot file, replacing it atomically
+
+        The file is a stream of pickled records: a (SNAPSHOT_VERSION, time) header followed by one
+        (name, entries) record per cache, so it can be loaded one cache at a time. If writing fails the
+        partial file is removed and the previous snapshot is left as it was.
+        """
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                pickle.dump((SNAPSHOT_VERSION, time.time()), f, pickle.HIGHEST_PROTOCOL)
+                for name, cache in list(self.caches.items()):
+                    if not cache.persist:
+                        continue
+                    pickle.dump((name, cache.dump()), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def load_snapshot(self, path):
+        """Loads a snapshot written by save_snapshot in to the registered caches, dropping expired entries
+
+        Caches in the snapshot which aren't registered or have persist off are skipped, as is the whole file if it's
+        from another SNAPSHOT_VERSION or can't be read.
+
+        Returns:
+            the number of entries loaded (int)
+        """
+        if not os.path.exists(path):
+            return 0
+        loaded = 0
+        try:
+            with open(path, "rb") as f:
+                version, saved = pickle.load(f)
+                if version != SNAPSHOT_VERSION:
+                    return 0
+                while True:
+                    try:
+                        name, entries = pickle.load(f)
+                    except EOFError:
+                        break
+                    if name in self.caches and self.caches[name].persist:
+                        loaded += self.caches[name].load(entries)
+        except (OSError, pickle.UnpicklingError, ValueError, TypeError, AttributeError, ImportError) as e:
+            print("failed to load cache snapshot %s: %r" % (path, e))
+        return loaded
+
+    @asyncio.coroutine
+    def snapshot_loop(self, path, interval=300):
+        """Saves a snapshot every interval seconds, forever. Schedule it once the caches have been loaded.
+
+        The snapshot is pickled and written in the loop's default executor so it doesn't stall the event loop,
+        and a failed save (an unpicklable value, a full disk) is logged and retried at the next interval."""
+        loop = asyncio.get_event_loop()
+        while True:
+            yield from asyncio.sleep(interval)
+            try:
+                yield from loop.run_in_executor(None, self.save_snapshot, path)
+            except Exception:
+                print("failed to save cache snapshot %s" % path)
+                traceback.print_exc()
+
+
+registry = CacheRegistry()
@@ -1,6 +1,5 @@
-from steamredis import RedisHandler
+from steamredis import RedisBatch, run_async, set_command
 import asyncio
-import discord
 import time
 
 
@@ -14,8 +13,8 @@ class Context:
         self.sredis = sredis # type: steamredis.RedisCollection
         self.sdata = sdata
         self.marked = False
-
-        self._prefix_handler = RedisHandler("prefixes", sredis.redis_server)
+        self.prefetched = {}
+        self.command = None
 
         self.cd_name = ""
         self.cd_userid = ""
@@ -24,36 +23,61 @@ class Context:
         self.message = message
         self.channel = message.channel
         self.formatting = ""
+        self.prefetched = {}
+        self.command = None
 
         return self
 
+    def prefetch(self, key=None):
+        """Reads everything in redis this message may need in one pipelined round trip, memoizing it on the context
+        until the next message: the prefixes, bans, server language, settings of the author and anyone they mention
+        and, if the command's key is given, its permissions"""
+        if key is not None:
+            self.set_command(key)
+        batch = RedisBatch(self.sredis.redis_server)
+        for helper in (self.sredis.prefixes, self.sredis.banned, self.sredis.languages, self.sredis.settings):
+            helper.prefetch(batch, self.message)
+        if key is not None:
+            self.sredis.permissions.prefetch(batch, self.message, key)
+        batch.execute(self.prefetched)
+
+    @asyncio.coroutine
+    def prefetch_async(self, key=None):
+        if key is not None:
+            self.set_command(key)  # on the loop, so it tags the task rather than the executor thread
+        yield from run_async(self.prefetch, key)
+
+    def set_command(self, name):
+        """Tags the redis calls made while handling this message with the command's name, see steamredis.stats"""
+        self.command = name
+        set_command(name)
+
     def format(self, message, include_head=True):
         if include_head:
             message = "Invalid usage: `" + message + "`"
         self.formatting = message
 
     def get_prefix(self, default):
-        if isinstance(self.channel, discord.Channel) and "channel::" + self.channel.id in self._prefix_handler:
-            return self._prefix_handler["channel::" + self.channel.id].decode("utf-8")
-        elif self.message.server is not None and "server::" + self.message.server.id in self._prefix_handler:
-            return self._prefix_handler["server::" + self.message.server.id].decode("utf-8")
-        else:
-            return default
+        for prefix in self.sredis.prefixes.get_prefixes(self.sredis.prefixes.keys_for(self.message), ctx=self):
+            if prefix is not None:
+                return prefix
+        return default
+
+    @asyncio.coroutine
+    def get_prefix_async(self, default):
+        result = yield from run_async(self.get_prefix, default)
+        return result
 
     def set_prefix(self, prefix, server_prefix=True):
         if server_prefix:
-            if prefix == "" or prefix == "steam ":
-                del self._prefix_handler["server::" + self.message.server.id]
-            else:
-                self._prefix_handler["server::" + self.message.server.id] = prefix
+            key = "server::" + self.message.server.id
         else:
-            if prefix == "" or prefix == "steam ":
-                del self._prefix_handler["channel::" + self.channel.id]
-            else:
-                self._prefix_handler["channel::" + self.channel.id] = prefix
+            key = "channel::" + self.channel.id
+        self.prefetched.pop((self.sredis.prefixes.handler.name, "get", key), None)
+        self.sredis.prefixes.set_prefix(key, None if prefix == "" or prefix == "steam " else prefix)
 
     def get_all_permissions(self, key):
-        return self.sredis.permissions.get_permissions(key, self.channel.server.id, True) + get_permissions(key, self.channel.id, False)
+        return self.sredis.permissions.get_all_permissions(key, self.channel.server.id, self.channel.id, ctx=self)
 
     def check_permissions(self, key):
         perms = self.get_all_permissions(key)
@@ -69,7 +93,7 @@ class Context:
         return True
 
     def is_premium(self):
-        return self.message.author.id in self.sredis.premium.get_premium_users()
+        return self.sredis.premium.is_premium(self.message.author.id)
 
     def cooldown(self, userid, name):
         self.cd_name = name
@@ -86,7 +110,12 @@ class Context:
 
     @property
     def lang(self):
-        return self.sredis.languages.get_language(self.message.author.id, self.message.server.id)
+        return self.sredis.languages.get_language(self.message.author.id, self.message.server.id, ctx=self)
+
+    @asyncio.coroutine
+    def get_lang_async(self):
+        result = yield from self.sredis.languages.get_language_async(self.message.author.id, self.message.server.id, ctx=self)
+        return result
 
     @asyncio.coroutine
     def say(self, message, dest=None):
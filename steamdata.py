@@ -13,6 +13,7 @@ class SteamData:
         self.valid_commands = []
 
         self.cooldown_whitelist = ["141964149356888064", "125526751064489984", "228782404775575553"]
+        self.owners = ["141964149356888064"]
 
         self.commands_count = 0
         self.start_time = time.time()
@@ -0,0 +1,166 @@
+import traceback
+import uuid
+from steamaudit import key_bytes
+
+# the schema version the keys in redis are at, every migration up to it has finished
+SCHEMA_VERSION_KEY = "schema::version"
+# SCAN cursor of an in-progress migration, so a restarted shard carries on where it stopped
+SCHEMA_CURSOR_KEY = "schema::cursor::%d"
+# which of a migration's SCAN patterns the saved cursor belongs to, for migrations with more than one
+SCHEMA_PATTERN_KEY = "schema::pattern::%d"
+# held by the shard running migrations so two don't run the same one at once
+SCHEMA_LOCK_KEY = "schema::lock"
+SCHEMA_LOCK_TTL = 600
+
+# ARGV: the lock token. deletes the lock only if it's still held with that token, so a shard whose lock expired
+# (and was taken by another) doesn't release the other shard's
+RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# ARGV: the lock token, ttl. extends the lock only if it's still held with that token, returning 1 if it was
+EXTEND_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class Migration:
+    """Converts every key matching a SCAN pattern from an old layout to a new one
+
+    Args:
+        version (int): the schema version the keys are at once it has run, migrations run in version order
+        description (str): what the migration does, for reports
+        match (str or list[str]): the SCAN pattern of the keys to convert, or several scanned one after another
+        convert (function): called with each matching key (bytes), it must skip keys already in the new layout
+            as SCAN may return them, and be safe to run twice on the same key in case a batch is interrupted
+    """
+    def __init__(self, version, description, match, convert):
+        self.version = version
+        self.description = description
+        self.match = match
+        self.convert = convert
+
+    @property
+    def patterns(self):
+        return [self.match] if isinstance(self.match, str) else list(self.match)
+
+
+class MigrationRunner:
+    """Runs the registered migrations online, in batches, against the schema version stored in redis.
+
+    Helpers register their migrations when they're created and use pending(version) to decide whether to fall back
+    to reading the old layout, which stays correct for the whole of a migration since it converts keys one by one.
+
+    Args:
+        client: the redis client to run the migrations with
+        collection (RedisCollection): used to share the schema version between shards over pub/sub
+    """
+    def __init__(self, client, collection):
+        self.redis = client
+        self.collection = collection
+        self.migrations = []
+        self.version = None
+        self._release_lock = client.register_script(RELEASE_LOCK_SCRIPT)
+        self._extend_lock = client.register_script(EXTEND_LOCK_SCRIPT)
+        collection.subscribe("schema::version", self.set_version)
+
+    def register(self, version, description, match, convert):
+        if any(migration.version == version for migration in self.migrations):
+            raise ValueError("schema version %d is already registered" % version)
+        self.migrations.append(Migration(version, description, match, convert))
+        self.migrations.sort(key=lambda migration: migration.version)
+
+    def set_version(self, version):
+        # None (after a pub/sub reconnect) makes pending() read it from redis again
+        self.version = int(version) if version is not None else None
+
+    def get_version(self):
+        version = self.redis.get(SCHEMA_VERSION_KEY)
+        self.version = int(version) if version is not None else 0
+        return self.version
+
+    def pending(self, version):
+        """Whether the given schema version's migration hasn't finished yet, so readers need to check the old layout.
+        The version is only read from redis the first time, after that it's kept up to date over pub/sub"""
+        if self.version is None:
+            self.get_version()
+        return self.version < version
+
+    def pending_migrations(self):
+        current = self.get_version()
+        return [migration for migration in self.migrations if migration.version > current]
+
+    def dry_run(self, batch_size=500):
+        """Counts what each pending migration would convert, without changing anything
+
+        Returns:
+            a list of dicts containing version, description, keys and bytes for each pending migration
+        """
+        report = []
+        for migration in self.pending_migrations():
+            keys = 0
+            size = 0
+            for pattern in migration.patterns:
+                for key in self.redis.scan_iter(match=pattern, count=batch_size):
+                    keys += 1
+                    size += key_bytes(self.redis, key)
+            report.append({"version": migration.version, "description": migration.description,
+                           "keys": keys, "bytes": size})
+        return report
+
+    def run(self, batch_size=500, max_batches=None):
+        """Runs the pending migrations in order, batch_size keys at a time, saving the SCAN cursor after each batch so
+        an interrupted migration resumes from there. Stops early after max_batches batches if given.
+
+        The lock is taken with a token unique to this run and only extended or released while it still holds that
+        token, so a run which stalled past SCHEMA_LOCK_TTL stops rather than carrying on alongside another shard's.
+
+        Returns:
+            the schema version reached (int), or None if another shard holds the migration lock
+        """
+        token = uuid.uuid4().hex
+        if not self.redis.set(SCHEMA_LOCK_KEY, token, nx=True, ex=SCHEMA_LOCK_TTL):
+            return None
+        batches = 0
+        try:
+            for migration in self.pending_migrations():
+                patterns = migration.patterns
+                pattern = int(self.redis.get(SCHEMA_PATTERN_KEY % migration.version) or 0)
+                cursor = int(self.redis.get(SCHEMA_CURSOR_KEY % migration.version) or 0)
+                print("running schema migration %d (%s) from cursor %d" % (migration.version, migration.description, cursor))
+                while pattern < len(patterns):
+                    cursor, keys = self.redis.scan(cursor, match=patterns[pattern], count=batch_size)
+                    for key in keys:
+                        try:
+                            migration.convert(key)
+                        except Exception:
+                            print("failed to migrate %s" % key)
+                            traceback.print_exc()
+                            raise
+                    cursor = int(cursor)
+                    if cursor == 0:
+                        pattern += 1
+                        if pattern == len(patterns):
+                            break
+                    if not self._extend_lock(keys=[SCHEMA_LOCK_KEY], args=[token, SCHEMA_LOCK_TTL]):
+                        print("lost the schema migration lock, stopping at cursor %d" % cursor)
+                        return None
+                    self.redis.set(SCHEMA_PATTERN_KEY % migration.version, str(pattern))
+                    self.redis.set(SCHEMA_CURSOR_KEY % migration.version, str(cursor))
+                    batches += 1
+                    if max_batches is not None and batches >= max_batches:
+                        return self.get_version()
+
+                self.redis.set(SCHEMA_VERSION_KEY, str(migration.version))
+                self.redis.delete(SCHEMA_CURSOR_KEY % migration.version, SCHEMA_PATTERN_KEY % migration.version)
+                self.version = migration.version
+                self.collection.publish("schema::version", str(migration.version))
+            return self.get_version()
+        finally:
+            self._release_lock(keys=[SCHEMA_LOCK_KEY], args=[token])
@@ -1,13 +1,315 @@
 import redis
 import discord
 import asyncio
+import functools
+import hashlib
 import time
 import os
 import json
+import math
+import threading
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from steamaudit import AUDIT_SAMPLE_RATE, audit_keyspace
+from steamcache import Cache
+from steammigrations import MigrationRunner
 from steamdata import BannedError, CommandPermissionError
 
 
+# the redis client blocks, so anything called from the event loop should go through run_async to run it in here
+REDIS_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# schema versions of the migrations registered by the helpers, see steammigrations
+SCHEMA_PERMISSION_SETS = 1
+SCHEMA_PERMISSION_CLEANUP = 2
+SCHEMA_BAN_SETS = 3
+SCHEMA_PREMIUM_SET = 4
+SCHEMA_BILLBOARD_NATIVE = 5
+SCHEMA_WATCHER_RECORDS = 6
+SCHEMA_WATCHER_OLD_MAP = 7
+SCHEMA_USER_SETTINGS = 8
+
+WATCHER_CHECK_INTERVAL = 1800  # seconds for the watcher scheduler to check every watched (appid, cc) once
+WATCHER_SLICES = 30  # how many slices each interval is split in to
+WATCHER_SLICE_BUDGET = 40  # the most (appid, cc) pairs a slice checks, the rest are carried over to the next interval
+WATCHER_ROLLOVER_WINDOW = 900  # pairs this many seconds either side of their region's price rollover are checked first
+
+NOTIFICATION_MESSAGE_LIMIT = 2000  # discord's message length limit, notification lines are packed in to messages up to it
+NOTIFICATION_CONCURRENCY = 5  # how many destinations notifications are sent to at once
+# (messages, seconds), the most notification messages sent to any one channel or pm in that many seconds, as discord
+# rate limits each channel separately
+NOTIFICATION_DESTINATION_RATE = (5, 5.0)
+NOTIFICATION_GLOBAL_RATE = (40, 1.0)  # (messages, seconds), the most notification messages sent in total
+
+# the fields of a watcher record, in the order the old ":"/"," joined watchers string stored them (minus cc)
+WATCHER_FIELDS = ("userid", "watcherid", "locationid", "locationtype", "percent", "gameid", "cc")
+
+PREMIUM_ROLES = ["209743495064322049", "220107636878737409", "254044942962393088",
+                 "229660520842526730", "229663214332411904"]
+PREMIUM_CHECK_INTERVAL = 60  # seconds between checking the premium version stamp, in case an invalidation was missed
+BAN_INDEX_CHECK_INTERVAL = 30  # seconds between checking the ban index version stamp, in case an invalidation was missed
+PREFIX_CACHE_SIZE = 100000  # channel and server prefixes kept in memory, the least recently used are dropped past this
+PREFIX_CACHE_TTL = 600  # seconds a cached prefix is trusted for, in case an invalidation was missed
+USER_SETTINGS_CACHE_SIZE = 50000  # user settings records kept in memory, the least recently used are dropped past this
+USER_SETTINGS_CACHE_TTL = 600  # seconds cached user settings are trusted for, in case an invalidation was missed
+
+# the user settings fields and the keys they were stored under before they were merged in to one hash
+USER_SETTINGS_LEGACY_KEYS = (("country", "countries::%s"), ("currency_code", "currencies::code::%s"),
+                             ("currency_symbol", "currencies::symbol::%s"), ("language", "languages::%s"),
+                             ("name", "names::%s"), ("mark", "marks::%s"))
+
+# reads a value stored either directly under KEYS[1], or as a list under KEYS[1]::length and KEYS[1]::0 to n-1.
+# returns {0, value} for the former and {1, item, item, ...} for the latter
+INDEXED_READ_SCRIPT = """
+local length = redis.call("GET", KEYS[1] .. "::length")
+if not length then
+    return {0, redis.call("GET", KEYS[1])}
+end
+local keys = {}
+for i = 0, tonumber(length) - 1 do
+    keys[#keys + 1] = KEYS[1] .. "::" .. i
+end
+if #keys == 0 then
+    return {1}
+end
+local values = redis.call("MGET", unpack(keys))
+table.insert(values, 1, 1)
+return values
+"""
+
+
+# removes ARGV[2..n] from the set KEYS[1], then ARGV[1] from the index set KEYS[2] if that left KEYS[1] empty.
+# returns the number of members removed
+REMOVE_INDEXED_MEMBERS_SCRIPT = """
+local removed = redis.call("SREM", KEYS[1], unpack(ARGV, 2))
+if redis.call("SCARD", KEYS[1]) == 0 then
+    redis.call("SREM", KEYS[2], ARGV[1])
+end
+return removed
+"""
+
+
+# upper bounds (in milliseconds) of the latency buckets reported by RedisStats
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+_command_local = threading.local()
+
+
+def _current_task():
+    try:
+        if hasattr(asyncio, "current_task"):
+            return asyncio.current_task()
+        return asyncio.Task.current_task()
+    except RuntimeError:
+        return None
+
+
+def set_command(name):
+    """Tags the redis calls made by the current task (and anything it runs through run_async) with a command name"""
+    task = _current_task()
+    if task is not None:
+        task.redis_command = name
+    else:
+        _command_local.command = name
+
+
+def current_command():
+    """Gets the command name redis calls made from here are tagged with, None if there isn't one"""
+    command = getattr(_command_local, "command", None)
+    if command is None:
+        command = getattr(_current_task(), "redis_command", None)
+    return command
+
+
+def _run_tagged(command, func, *args, **kwargs):
+    _command_local.command = command
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _command_local.command = None
+
+
+# ARGV: key prefix, userid, locationid, locationtype, percent, gameid, cc, watcher cap.
+# adds a watcher record and its indexes, returning its id, -1 if the user is at the cap or -2 if it's a duplicate
+ADD_WATCHER_SCRIPT = """
+local prefix = ARGV[1]
+local user_set = prefix .. "::user::" .. ARGV[2] .. "::set"
+if redis.call("SCARD", user_set) >= tonumber(ARGV[8]) then
+    return -1
+end
+local user_map = prefix .. "::user::" .. ARGV[2] .. "::map"
+local field = ARGV[3] .. "::" .. ARGV[6]
+if redis.call("HEXISTS", user_map, field) == 1 then
+    return -2
+end
+local watcherid = redis.call("INCR", prefix .. "::watcherid") - 1
+redis.call("HSET", user_map, field, watcherid)
+redis.call("HMSET", prefix .. "::watcher::" .. watcherid, "userid", ARGV[2], "watcherid", watcherid, "locationid", ARGV[3],
+           "locationtype", ARGV[4], "percent", ARGV[5], "gameid", ARGV[6], "cc", ARGV[7])
+redis.call("SADD", user_set, watcherid)
+redis.call("SADD", prefix .. "::game::" .. ARGV[6] .. "::" .. ARGV[7] .. "::set", watcherid)
+redis.call("SADD", prefix .. "::games::set", ARGV[6] .. "::" .. ARGV[7])
+return watcherid
+"""
+
+# ARGV: key prefix, userid, watcherid. removes a watcher record and its indexes (and the discount state of its game
+# if nothing else watches it) if it belongs to the user, returning 1 if it did and 0 otherwise
+REMOVE_WATCHER_SCRIPT = """
+local prefix = ARGV[1]
+local record = prefix .. "::watcher::" .. ARGV[3]
+local fields = redis.call("HMGET", record, "userid", "locationid", "gameid", "cc")
+if fields[1] ~= ARGV[2] then
+    return 0
+end
+redis.call("DEL", record)
+redis.call("SREM", prefix .. "::user::" .. ARGV[2] .. "::set", ARGV[3])
+redis.call("HDEL", prefix .. "::user::" .. ARGV[2] .. "::map", fields[2] .. "::" .. fields[3])
+local game_set = prefix .. "::game::" .. fields[3] .. "::" .. fields[4] .. "::set"
+redis.call("SREM", game_set, ARGV[3])
+if redis.call("SCARD", game_set) == 0 then
+    redis.call("SREM", prefix .. "::games::set", fields[3] .. "::" .. fields[4])
+    redis.call("HDEL", prefix .. "::old::map", fields[3] .. "::" .. fields[4])
+end
+return 1
+"""
+
+
+# KEYS: the user settings hash, then the old key of each field in ARGV. copies every old value over (unless the hash
+# already has the field, which means it was set since) and deletes the old keys
+MIGRATE_USER_SETTINGS_SCRIPT = """
+for i = 1, #ARGV do
+    local value = redis.call("GET", KEYS[i + 1])
+    if value then
+        redis.call("HSETNX", KEYS[1], ARGV[i], value)
+        redis.call("DEL", KEYS[i + 1])
+    end
+end
+"""
+
+
+@asyncio.coroutine
+def run_async(func, *args, **kwargs):
+    """Runs a blocking function, such as a RedisHandler or *Redis helper method, in REDIS_EXECUTOR
+    so it doesn't stall the event loop while it waits on redis"""
+    loop = asyncio.get_event_loop()
+    result = yield from loop.run_in_executor(REDIS_EXECUTOR, functools.partial(_run_tagged, current_command(), func, *args, **kwargs))
+    return result
+
+
+class RedisStats:
+    """Counts redis round trips and their latencies, tagged by helper (the RedisHandler name), command and operation"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.entries = {}  # (helper, command, op) -> [count, total seconds, max seconds, bucket counts]
+
+    def record(self, helper, command, op, seconds):
+        with self.lock:
+            entry = self.entries.get((helper, command, op))
+            if entry is None:
+                entry = self.entries[(helper, command, op)] = [0, 0.0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            milliseconds = seconds * 1000
+            for i, limit in enumerate(LATENCY_BUCKETS):
+                if milliseconds < limit:
+                    entry[3][i] += 1
+                    break
+            else:
+                entry[3][-1] += 1
+
+    def reset(self):
+        with self.lock:
+            self.entries = {}
+            self.started = time.time()
+
+    def snapshot(self, by=("helper", "command", "op")):
+        """Gets the stats grouped by any of helper, command and op
+
+        Returns:
+            an OrderedDict mapping each group (a tuple in the order of by) to a dict containing count, seconds, max,
+            mean and histogram, where histogram maps each LATENCY_BUCKETS label (plus the overflow) to a count
+        """
+        fields = ("helper", "command", "op")
+        labels = ["<%dms" % limit for limit in LATENCY_BUCKETS] + [">=%dms" % LATENCY_BUCKETS[-1]]
+        with self.lock:
+            entries = [(key, list(entry[:3]) + [list(entry[3])]) for key, entry in self.entries.items()]
+        groups = {}
+        for key, (count, seconds, maximum, buckets) in entries:
+            group = tuple(key[fields.index(field)] for field in by)
+            total = groups.setdefault(group, [0, 0.0, 0.0, [0] * len(labels)])
+            total[0] += count
+            total[1] += seconds
+            total[2] = max(total[2], maximum)
+            total[3] = [a + b for a, b in zip(total[3], buckets)]
+        snapshot = OrderedDict()
+        for group, (count, seconds, maximum, buckets) in sorted(groups.items(), key=lambda item: -item[1][1]):
+            snapshot[group] = {"count": count, "seconds": seconds, "max": maximum, "mean": seconds / count,
+                               "histogram": OrderedDict(zip(labels, buckets))}
+        return snapshot
+
+    def report(self, by=("helper", "command")):
+        """Formats a snapshot in to lines of a table, slowest total first"""
+        lines = ["%-30s %8s %9s %8s %8s" % ("/".join(by), "calls", "total ms", "mean ms", "max ms")]
+        for group, stats in self.snapshot(by).items():
+            lines.append("%-30s %8d %9.1f %8.2f %8.2f" % ("/".join(str(part) for part in group), stats["count"],
+                                                          stats["seconds"] * 1000, stats["mean"] * 1000,
+                                                          stats["max"] * 1000))
+        return lines
+
+
+stats = RedisStats()
+
+
+class InstrumentedRedis:
+    """Wraps a redis client, recording every call (and every pipeline execute) in stats under a helper name"""
+    def __init__(self, client, helper):
+        self.client = client
+        self.helper = helper
+
+    def _timed(self, op, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.record(self.helper, current_command(), op, time.perf_counter() - start)
+        return timed
+
+    def pipeline(self, *args, **kwargs):
+        return InstrumentedPipeline(self.client.pipeline(*args, **kwargs), self)
+
+    def register_script(self, script):
+        registered = self.client.register_script(script)
+
+        def call(keys=[], args=[], client=None):
+            if isinstance(client, InstrumentedPipeline):
+                return registered(keys=keys, args=args, client=client.pipe)
+            return self._timed("script", registered)(keys=keys, args=args, client=client)
+        return call
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if callable(attr) and name not in ("pubsub", "scan_iter"):
+            return self._timed(name, attr)
+        return attr
+
+
+class InstrumentedPipeline:
+    def __init__(self, pipe, redis):
+        self.pipe = pipe
+        self.redis = redis
+
+    def execute(self, *args, **kwargs):
+        return self.redis._timed("pipeline", self.pipe.execute)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+
 class LanguageError(Exception):
     pass
 
@@ -17,51 +319,37 @@ class Language:
     def load_language(name, backup=None):
         if os.path.exists("languages/" + name + ".json"):
             with open("languages/" + name + ".json", "rb") as f:
-                return Language(name, json.loads(f.read().decode("utf-8")), backup=backup)
+                raw = f.read()
+            return Language(name, json.loads(raw.decode("utf-8")), backup=backup, version=hashlib.sha1(raw).hexdigest())
         return None
 
-    def __init__(self, collection, name, dct, backup=None):
-        self.collection = collection
+    def __init__(self, name, dct, backup=None, version=None):
         self.name = name
-        self.handler = RedisHandler("languageshub::" + name, collection.redis_server)
+        self.raw = dct
         self.backup = backup
-        self.update_server(dct)
-
-    def update_server(self, dct):
-        for section in dct:
-            for item in dct[section]:
-                if isinstance(dct[section][item], list) or isinstance(dct[section][item], tuple):
-                    self.handler[section + "::" + item + "::length"] = len(dct[section][item])
-                    for i in range(len(dct[section][item])):
-                        self.handler[section + "::" + item + "::" + str(i)] = dct[section][item][i]
-                else:
-                    self.handler[section + "::" + item] = dct[section][item]
+        self.version = version
+        self.tables = {}
+        self.resolve()
+
+    def resolve(self):
+        """Rebuilds the lookup tables from this language's strings, falling back to the backup language's"""
+        tables = {}
+        if self.backup is not None:
+            for section in self.backup.tables:
+                tables[section] = dict(self.backup.tables[section])
+        for section in self.raw:
+            tables.setdefault(section, {}).update(self.raw[section])
+        self.tables = tables
 
     def get(self, base, name, join=True):
-        key = base + "::" + name
-        if key + "::length" in self.handler:
-            length = int(self.handler[key + "::length"].decode("utf-8"))
-            result = [""] * length
-            for i in range(length):
-                result[i] = self.handler[key + "::" + str(i)].decode("utf-8")
+        if base not in self.tables or name not in self.tables[base]:
+            raise LanguageError("failed to resolve language key " + base + "/" + name)
+        result = self.tables[base][name]
+        if isinstance(result, list) or isinstance(result, tuple):
             if join:
                 return "\n".join(result)
-            return result
-        elif key in self.handler:
-            return self.handler[key].decode("utf-8")
-        elif self.backup is not None:
-            return self.backup.get(base, name, join=join)
-        else:
-            raise LanguageError("failed to resolve language key " + base + "/" + name)
-
-    #def get(self, base, name, join=True):
-    #    if base in self.raw and name in self.raw[base]:
-    #        result = self.raw[base][name]
-    #        if isinstance(result, list) and join:
-    #            return "\n".join(result)
-    #        return result
-    #    else:
-    #        raise LanguageError
+            return list(result)
+        return result
 
     def get_cooldown(self, name, join=True):
         return self.get("cooldowns", name, join=join)
@@ -79,7 +367,8 @@ class Language:
 class RedisHandler:
     def __init__(self, name, redis):
         self.name = name
-        self.redis = redis
+        self.redis = InstrumentedRedis(redis.client if isinstance(redis, InstrumentedRedis) else redis, name)
+        self._indexed_read = self.redis.register_script(INDEXED_READ_SCRIPT)
 
     def __setitem__(self, key, value):
         self.redis.set(self.name + "::" + key, value)
@@ -93,13 +382,224 @@ class RedisHandler:
     def __delitem__(self, key):
         self.redis.delete(self.name + "::" + key)
 
+    def get(self, key, default=None, memo=None):
+        """Reads a key in one round trip, returning its decoded value or default if it doesn't exist.
+        If a memo (see RedisBatch) is given it's read from first and filled in with anything read from redis"""
+        return self.get_many([key], default, memo)[0]
+
+    def get_many(self, keys, default=None, memo=None):
+        """Reads several keys in one MGET, returning a list of their decoded values (default for any that don't exist)"""
+        if memo is None:
+            memo = {}
+        missing = [key for key in keys if (self.name, "get", key) not in memo]
+        if len(missing) > 0:
+            values = self.redis.mget([self.name + "::" + key for key in missing])
+            for key, value in zip(missing, values):
+                memo[(self.name, "get", key)] = self.decode_read("get", value)
+        values = [memo[(self.name, "get", key)] for key in keys]
+        return [value if value is not None else default for value in values]
+
+    def set_many(self, mapping):
+        """Writes several keys in one atomic MSET"""
+        if len(mapping) > 0:
+            self.redis.mset({self.name + "::" + key: value for key, value in mapping.items()})
+
+    def get_indexed(self, key, default=None, memo=None):
+        """Reads a value which is either a single key or an indexed list (key::length and key::0 to key::n-1)
+        in one round trip, returning a string, a list of strings or default if neither exist"""
+        if memo is None:
+            memo = {}
+        if (self.name, "indexed", key) not in memo:
+            memo[(self.name, "indexed", key)] = self.decode_read("indexed", self._indexed_read(keys=[self.name + "::" + key]))
+        value = memo[(self.name, "indexed", key)]
+        return value if value is not None else default
+
+    def get_members(self, key, memo=None):
+        """Reads a set in one SMEMBERS, returning its decoded members (an empty set if it doesn't exist)"""
+        return self.get_members_many([key], memo)[0]
+
+    def get_members_many(self, keys, memo=None):
+        """Reads several sets in one pipelined round trip, returning a list of sets of their decoded members"""
+        if memo is None:
+            memo = {}
+        missing = [key for key in keys if (self.name, "members", key) not in memo]
+        if len(missing) > 0:
+            pipe = self.redis.pipeline(transaction=False)
+            for key in missing:
+                self.queue_read(pipe, "members", key)
+            for key, value in zip(missing, pipe.execute()):
+                memo[(self.name, "members", key)] = self.decode_read("members", value)
+        return [memo[(self.name, "members", key)] for key in keys]
+
+    def add_members(self, key, values):
+        """Adds values to a set in one atomic SADD, returning how many weren't already in it"""
+        if len(values) == 0:
+            return 0
+        return self.redis.sadd(self.name + "::" + key, *values)
+
+    def remove_members(self, key, values):
+        """Removes values from a set in one transaction, returning the ones which were in it"""
+        pipe = self.redis.pipeline()
+        for value in values:
+            pipe.srem(self.name + "::" + key, value)
+        return [value for value, removed in zip(values, pipe.execute()) if removed]
+
+    def replace_members(self, key, values):
+        """Replaces the whole of a set in one transaction"""
+        pipe = self.redis.pipeline()
+        pipe.delete(self.name + "::" + key)
+        if len(values) > 0:
+            pipe.sadd(self.name + "::" + key, *values)
+        pipe.execute()
+
+    def get_map(self, key, memo=None):
+        """Reads a hash in one HGETALL, returning a dict of its decoded fields (empty if it doesn't exist)"""
+        if memo is None:
+            memo = {}
+        if (self.name, "map", key) not in memo:
+            memo[(self.name, "map", key)] = self.decode_read("map", self.redis.hgetall(self.name + "::" + key))
+        return memo[(self.name, "map", key)]
+
+    def set_map_items(self, key, mapping):
+        """Sets fields of a hash in one atomic HMSET, leaving the others alone"""
+        if len(mapping) > 0:
+            self.redis.hmset(self.name + "::" + key, mapping)
+
+    def delete_map_items(self, key, fields):
+        """Removes fields from a hash in one atomic HDEL, returning how many existed"""
+        if len(fields) == 0:
+            return 0
+        return self.redis.hdel(self.name + "::" + key, *fields)
+
+    def replace_map(self, key, mapping):
+        """Replaces the whole of a hash in one transaction"""
+        pipe = self.redis.pipeline()
+        pipe.delete(self.name + "::" + key)
+        if len(mapping) > 0:
+            pipe.hmset(self.name + "::" + key, mapping)
+        pipe.execute()
+
+    def queue_read(self, pipe, op, key):
+        """Adds a read to a pipeline, op is one of the RedisBatch read types"""
+        if op == "get":
+            pipe.get(self.name + "::" + key)
+        elif op == "indexed":
+            self._indexed_read(keys=[self.name + "::" + key], client=pipe)
+        elif op == "members":
+            pipe.smembers(self.name + "::" + key)
+        elif op == "map":
+            pipe.hgetall(self.name + "::" + key)
+
+    def decode_read(self, op, value):
+        """Decodes the raw result of a read queued with queue_read, giving None if there was nothing there
+        (or an empty set for members and an empty dict for map)"""
+        if op == "members":
+            return {member.decode("utf-8") for member in value}
+        if op == "map":
+            return {field.decode("utf-8"): item.decode("utf-8") for field, item in value.items()}
+        if op == "indexed":
+            if value[0] == 1:
+                return [item.decode("utf-8") if item is not None else "" for item in value[1:]]
+            value = value[1] if len(value) > 1 else None
+        return value.decode("utf-8") if value is not None else None
+
+    @asyncio.coroutine
+    def get_async(self, item):
+        result = yield from run_async(self.__getitem__, item)
+        return result
+
+    @asyncio.coroutine
+    def set_async(self, key, value):
+        yield from run_async(self.__setitem__, key, value)
+
+    @asyncio.coroutine
+    def contains_async(self, item):
+        result = yield from run_async(self.__contains__, item)
+        return result
+
+    @asyncio.coroutine
+    def delete_async(self, key):
+        yield from run_async(self.__delitem__, key)
+
+
+class RedisBatch:
+    """Queues reads from any number of RedisHandlers and makes them all in one pipelined round trip.
+    The results go in to a memo dict, which the RedisHandler reads take to avoid reading those keys again"""
+    def __init__(self, redis):
+        self.redis = InstrumentedRedis(redis.client if isinstance(redis, InstrumentedRedis) else redis, "batch")
+        self.reads = []
+        self.stamps = {}
+
+    def get(self, handler, key):
+        self.reads.append((handler, "get", key))
+
+    def get_many(self, handler, keys):
+        for key in keys:
+            self.get(handler, key)
+
+    def get_indexed(self, handler, key):
+        self.reads.append((handler, "indexed", key))
+
+    def get_members(self, handler, key):
+        self.reads.append((handler, "members", key))
+
+    def get_map(self, handler, key):
+        self.reads.append((handler, "map", key))
+
+    def stamp(self, key, value):
+        """Puts a value in the memo along with the reads, such as a helper's invalidation counter from when they were
+        queued. An earlier stamp under the same key is kept, as the memo may already hold reads made back then"""
+        self.stamps[key] = value
+
+    def execute(self, memo=None):
+        """Reads everything queued which isn't in the memo yet
+
+        Returns:
+            the memo, mapping (handler name, read type, key) to decoded values (None where nothing was found)
+        """
+        if memo is None:
+            memo = {}
+        reads = [(handler, op, key) for handler, op, key in self.reads if (handler.name, op, key) not in memo]
+        if len(reads) > 0:
+            pipe = self.redis.pipeline(transaction=False)
+            for handler, op, key in reads:
+                handler.queue_read(pipe, op, key)
+            for (handler, op, key), value in zip(reads, pipe.execute()):
+                memo[(handler.name, op, key)] = handler.decode_read(op, value)
+        for key, value in self.stamps.items():
+            memo.setdefault(key, value)
+        self.reads = []
+        self.stamps = {}
+        return memo
+
+
+def _memo(ctx):
+    """Internal method giving the prefetch memo of a Context, helpers take a ctx so they can read through it"""
+    return ctx.prefetched if ctx is not None else None
+
+
+class RedisHelper:
+    """Base of the *Redis helpers. Their methods all block on redis, so from the event loop
+    call them through run_async, e.g. yield from sredis.country.run_async("get_country", userid)"""
+
+    @asyncio.coroutine
+    def run_async(self, method, *args, **kwargs):
+        result = yield from run_async(getattr(self, method), *args, **kwargs)
+        return result
+
 
 class RedisCollection:
+    run_async = staticmethod(run_async)
+
     def __init__(self, client, steamsearch, sdata):
         self.redis_server = redis.StrictRedis(host="localhost", port=6379, db=0)
         self.client = client
         self.steamsearch = steamsearch
         self.sdata = sdata
+        self.loop = asyncio.get_event_loop()
+        self.pubsub = self.redis_server.pubsub(ignore_subscribe_messages=True)
+        self.subscriptions = {}
+        self.migrations = MigrationRunner(InstrumentedRedis(self.redis_server, "schema"), self)
 
         self.watcher = WatcherRedis(self)
         self.premium = PremiumRedis(self)
@@ -114,96 +614,452 @@ class RedisCollection:
         self.recommendations = RecommendationRedis(self)
         self.query = QueryRedis(self)
         self.shard_tracker = ShardTrackerRedis(self)
+        self.prefixes = PrefixRedis(self)
+        self.settings = UserSettingsRedis(self)
+        self.watcher_scheduler = WatcherScheduler(self.watcher)
+
+        self.listener = threading.Thread(target=self._listen, name="redis-pubsub", daemon=True)
+        self.listener.start()
+
+    def namespaces(self):
+        """Gets the names of every RedisHandler the helpers use, which prefix all the keys they store"""
+        names = ["schema"]
+        for helper in vars(self).values():
+            if isinstance(helper, RedisHelper):
+                for handler in vars(helper).values():
+                    if isinstance(handler, RedisHandler) and handler.name not in names:
+                        names.append(handler.name)
+        return names
+
+    def audit(self, batch_size=500, sample_rate=AUDIT_SAMPLE_RATE):
+        """Reports the keys, memory and suspected orphans of every namespace, see steamaudit.audit_keyspace"""
+        return audit_keyspace(InstrumentedRedis(self.redis_server, "audit"), self.namespaces(), batch_size, sample_rate)
+
+    def subscribe(self, channel, callback):
+        """Calls callback(data) on the event loop with the decoded data of every message published to channel,
+        by this shard or any other. Helpers subscribe in their constructors, before the listener starts.
+        After the listener reconnects the callback is called with None, as messages may have been missed"""
+        if channel not in self.subscriptions:
+            self.subscriptions[channel] = []
+            self.pubsub.subscribe(channel)
+        self.subscriptions[channel].append(callback)
+
+    def publish(self, channel, data):
+        self.redis_server.publish(channel, data)
+
+    def _listen(self):
+        while True:
+            try:
+                for message in self.pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    channel = message["channel"].decode("utf-8")
+                    data = message["data"].decode("utf-8")
+                    for callback in self.subscriptions.get(channel, []):
+                        self.loop.call_soon_threadsafe(callback, data)
+            except redis.ConnectionError:
+                traceback.print_exc()
+                time.sleep(1)
+            # anything published while disconnected was missed, so tell every subscriber to drop everything
+            for callbacks in self.subscriptions.values():
+                for callback in callbacks:
+                    self.loop.call_soon_threadsafe(callback, None)
+
+
+class PrefixRedis(RedisHelper):
+    """Channel and server prefixes, kept in a bounded local cache (including the ones which aren't set) so resolving
+    a prefix normally doesn't touch redis. Changes are published on prefixes::invalidate so every shard drops them,
+    and entries expire after PREFIX_CACHE_TTL seconds in case an invalidation was missed"""
+    def __init__(self, collection):
+        self.collection = collection
+        self.handler = RedisHandler("prefixes", collection.redis_server)
+        self.cache = Cache("prefixes", max_size=PREFIX_CACHE_SIZE, ttl=PREFIX_CACHE_TTL, persist=False)
+        self._generation = 0
+        collection.subscribe("prefixes::invalidate", self.invalidate)
+
+    def keys_for(self, msg):
+        keys = []
+        if isinstance(msg.channel, discord.Channel):
+            keys.append("channel::" + msg.channel.id)
+        if msg.server is not None:
+            keys.append("server::" + msg.server.id)
+        return keys
+
+    def prefetch(self, batch, msg):
+        batch.get_many(self.handler, [key for key in self.keys_for(msg) if key not in self.cache])
+
+    def get_prefixes(self, keys, ctx=None):
+        """Gets the prefixes set for each key (None where there isn't one), reading only uncached keys from redis"""
+        prefixes = {}
+        missing = []
+        for key in keys:
+            if key in self.cache:
+                prefixes[key] = self.cache.get(key)
+            else:
+                missing.append(key)
+        if len(missing) > 0:
+            generation = self._generation
+            for key, prefix in zip(missing, self.handler.get_many(missing, memo=_memo(ctx))):
+                prefixes[key] = prefix
+                # an invalidation while reading may be for a change made after the read, so don't keep it
+                if generation == self._generation:
+                    self.cache[key] = prefix
+        return [prefixes[key] for key in keys]
+
+    def set_prefix(self, key, prefix):
+        """Sets (or with None, removes) the prefix for a key and tells every shard to drop its cached copy"""
+        if prefix is None:
+            del self.handler[key]
+        else:
+            self.handler[key] = prefix
+        self.invalidate(key)
+        self.collection.publish("prefixes::invalidate", key)
+
+    def invalidate(self, key):
+        """Drops a key from the cache, or everything if key is None"""
+        self._generation += 1
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(key)
+
 
+class UserSettingsRedis(RedisHelper):
+    """A user's country, currency, language, saved name and mark, stored together in the usersettings::<userid> hash
+    and kept in a bounded local cache. Writes drop the cached copy on every shard through usersettings::invalidate,
+    and cached copies expire after USER_SETTINGS_CACHE_TTL seconds in case an invalidation was missed.
 
-class WatcherRedis:
+    The settings used to be stored under a key each (USER_SETTINGS_LEGACY_KEYS), which a migration moves in to the
+    hashes and deletes. Until it has finished, reads merge in the old keys and deletes remove them too."""
+    def __init__(self, collection):
+        self.collection = collection
+        self.handler = RedisHandler("usersettings", collection.redis_server)
+        self.cache = Cache("usersettings", max_size=USER_SETTINGS_CACHE_SIZE, ttl=USER_SETTINGS_CACHE_TTL,
+                           persist=False)
+        self._generation = 0
+        self._migrate_user = self.handler.redis.register_script(MIGRATE_USER_SETTINGS_SCRIPT)
+        collection.subscribe("usersettings::invalidate", self.invalidate)
+        collection.migrations.register(SCHEMA_USER_SETTINGS, "user settings keys to hashes",
+                                       [key % "*" for _, key in USER_SETTINGS_LEGACY_KEYS], self.migrate_legacy_key)
+
+    def invalidate(self, userid):
+        """Drops a user from the cache, or everyone if userid is None"""
+        self._generation += 1
+        if userid is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(userid)
+
+    def userids_for(self, msg):
+        userids = [msg.author.id]
+        if len(msg.mentions) == 1 and msg.mentions[0].id != msg.author.id:
+            userids.append(msg.mentions[0].id)
+        return userids
+
+    def prefetch(self, batch, msg):
+        batch.stamp((self.handler.name, "generation"), self._generation)
+        for userid in self.userids_for(msg):
+            if userid not in self.cache:
+                batch.get_map(self.handler, userid)
+
+    def _legacy_settings(self, userid):
+        values = self.handler.redis.mget([key % userid for _, key in USER_SETTINGS_LEGACY_KEYS])
+        return {field: value.decode("utf-8") for (field, _), value in zip(USER_SETTINGS_LEGACY_KEYS, values)
+                if value is not None}
+
+    def migrate_legacy_key(self, key):
+        # every old key of the user is moved at once, so the rest are already gone when SCAN gets to them
+        key = key.decode("utf-8")
+        for _, legacy_key in USER_SETTINGS_LEGACY_KEYS:
+            prefix = legacy_key % ""
+            # languages:: also holds languages::server::<serverid>, which stays where it is
+            if key.startswith(prefix) and "::" not in key[len(prefix):]:
+                userid = key[len(prefix):]
+                break
+        else:
+            return
+        keys = [self.handler.name + "::" + userid] + [legacy_key % userid for _, legacy_key in USER_SETTINGS_LEGACY_KEYS]
+        self._migrate_user(keys=keys, args=[field for field, _ in USER_SETTINGS_LEGACY_KEYS])
+
+    def get_settings(self, userid, ctx=None):
+        """Gets all of a user's settings as a dict, from the local cache if possible"""
+        settings = self.cache.get(userid)
+        if settings is None:
+            memo = _memo(ctx)
+            if memo is not None and (self.handler.name, "map", userid) in memo:
+                # prefetched settings are as old as the prefetch, which may be from before a write
+                generation = memo.get((self.handler.name, "generation"))
+            else:
+                generation = self._generation
+            settings = self.handler.get_map(userid, memo=memo)
+            if self.collection.migrations.pending(SCHEMA_USER_SETTINGS):
+                settings = dict(self._legacy_settings(userid), **settings)
+            # an invalidation since reading may be for a change made after the read, so don't keep it
+            if generation == self._generation:
+                self.cache[userid] = settings
+        return settings
+
+    def get(self, userid, field, default=None, ctx=None):
+        return self.get_settings(userid, ctx).get(field, default)
+
+    def get_many(self, userids, field, default=None):
+        """Gets one setting for each of several users, reading the ones which aren't cached in one pipelined round
+        trip (plus an MGET of the old keys while the settings migration is pending)
+
+        Returns:
+            a dict mapping each userid to its value, default where it isn't set
+        """
+        values = {}
+        missing = []
+        for userid in set(userids):
+            settings = self.cache.get(userid)
+            if settings is not None:
+                values[userid] = settings.get(field, default)
+            else:
+                missing.append(userid)
+        if len(missing) > 0:
+            pipe = self.handler.redis.pipeline(transaction=False)
+            for userid in missing:
+                pipe.hget(self.handler.name + "::" + userid, field)
+            found = pipe.execute()
+            legacy = [None] * len(missing)
+            if self.collection.migrations.pending(SCHEMA_USER_SETTINGS):
+                legacy_key = dict(USER_SETTINGS_LEGACY_KEYS)[field]
+                legacy = self.handler.redis.mget([legacy_key % userid for userid in missing])
+            for userid, value, legacy_value in zip(missing, found, legacy):
+                value = value if value is not None else legacy_value
+                values[userid] = value.decode("utf-8") if value is not None else default
+        return values
+
+    def _forget(self, userid, ctx):
+        self.invalidate(userid)
+        if ctx is not None:
+            ctx.prefetched.pop((self.handler.name, "map", userid), None)
+        self.collection.publish("usersettings::invalidate", userid)
+
+    def set_settings(self, userid, settings, ctx=None):
+        """Sets some of a user's settings in one HMSET, leaving the rest alone. Given the message's ctx, later reads
+        for the same message see the change rather than the prefetched settings"""
+        self.handler.set_map_items(userid, settings)
+        self._forget(userid, ctx)
+
+    def delete_settings(self, userid, fields, ctx=None):
+        self.handler.delete_map_items(userid, fields)
+        if self.collection.migrations.pending(SCHEMA_USER_SETTINGS):
+            legacy_keys = dict(USER_SETTINGS_LEGACY_KEYS)
+            keys = [legacy_keys[field] % userid for field in fields if field in legacy_keys]
+            if len(keys) > 0:
+                self.handler.redis.delete(*keys)
+        self._forget(userid, ctx)
+
+
+class WatcherRedis(RedisHelper):
+    """Each watcher is a watcher::<watcherid> hash of WATCHER_FIELDS, indexed by user (user::<userid>::set, plus
+    user::<userid>::map from locationid::gameid to watcherid for duplicate checks) and by what gets checked
+    (game::<gameid>::<cc>::set, with games::set listing every gameid::cc). Adding and removing are atomic scripts.
+
+    A watcher is checked in the country its user had when it was added."""
     def __init__(self, collection):
         self.handler = RedisHandler("watcher", collection.redis_server)
         self.collection = collection
+        self._add_watcher = self.handler.redis.register_script(ADD_WATCHER_SCRIPT)
+        self._remove_watcher = self.handler.redis.register_script(REMOVE_WATCHER_SCRIPT)
+        self.notifications = NotificationDispatcher(collection.client)
+        collection.migrations.register(SCHEMA_WATCHER_RECORDS, "watchers string to indexed records",
+                                       self.handler.name + "::watchers", self.migrate_watchers_key)
+        collection.migrations.register(SCHEMA_WATCHER_OLD_MAP, "discount state string to hash",
+                                       self.handler.name + "::old", self.migrate_old_key)
+
+    def _parse_legacy_old(self, raw_old):
+        return {a[0]: float(a[1]) for a in [x.split(",") for x in raw_old.split(":") if x != ""]}
+
+    def get_old(self, games=None):
+        """Gets the discount percents seen by the last check, as {(appid, cc): percent}, for every game or only
+        the given (appid, cc) pairs"""
+        if games is None:
+            old = {tuple(field.split("::")): float(percent) for field, percent in self.handler.get_map("old::map").items()}
+            games = self.get_games()
+        else:
+            fields = [appid + "::" + cc for appid, cc in games]
+            percents = self.handler.redis.hmget(self.handler.name + "::old::map", fields) if len(fields) > 0 else []
+            old = {game: float(percent) for game, percent in zip(games, percents) if percent is not None}
+        if self.collection.migrations.pending(SCHEMA_WATCHER_OLD_MAP):
+            legacy = self._parse_legacy_old(self.handler.get("old", ""))
+            for appid, cc in games:
+                if appid in legacy:
+                    old.setdefault((appid, cc), legacy[appid])
+        return old
+
+    def set_old(self, old, previous=None):
+        """Stores the discount percents seen by a check. Given the previous ones (from get_old) only the entries
+        which changed are written, and the ones no longer checked removed, otherwise the whole hash is replaced"""
+        if previous is None:
+            self.handler.replace_map("old::map", {appid + "::" + cc: str(percent) for (appid, cc), percent in old.items()})
+            return
+        changed = {appid + "::" + cc: str(percent) for (appid, cc), percent in old.items()
+                   if previous.get((appid, cc)) != percent}
+        removed = [appid + "::" + cc for (appid, cc) in previous if (appid, cc) not in old]
+        pipe = self.handler.redis.pipeline()
+        if len(changed) > 0:
+            pipe.hmset(self.handler.name + "::old::map", changed)
+        if len(removed) > 0:
+            pipe.hdel(self.handler.name + "::old::map", *removed)
+        if len(changed) > 0 or len(removed) > 0:
+            pipe.execute()
+
+    def migrate_old_key(self, rediskey):
+        legacy = self._parse_legacy_old(self.handler.get("old", ""))
+        pipe = self.handler.redis.pipeline()
+        for game in self.handler.get_members("games::set"):
+            appid = game.split("::")[0]
+            if appid in legacy:
+                pipe.hsetnx(self.handler.name + "::old::map", game, str(legacy[appid]))
+        pipe.delete(rediskey)
+        pipe.execute()
 
-    def get_old(self):
-        if "old" in self.handler:
-            raw_old = self.handler["old"].decode("utf-8")
-            return {a[0]: float(a[1]) for a in [x.split(",") for x in raw_old.split(":") if x != ""]}
-        return {}
+    def get_watcher_game_name(self, gameid):
+        return self.handler.get("gamename::" + str(gameid), str(gameid))
+
+    def get_watcher_game_names(self, gameids):
+        """Gets the saved names of several games in one MGET, as a dict mapping gameid to name (the id if unnamed)"""
+        gameids = list(gameids)
+        names = self.handler.get_many(["gamename::" + str(gameid) for gameid in gameids])
+        return {gameid: name if name is not None else str(gameid) for gameid, name in zip(gameids, names)}
+
+    def _get_records(self, watcherids):
+        pipe = self.handler.redis.pipeline(transaction=False)
+        for watcherid in watcherids:
+            pipe.hgetall(self.handler.name + "::watcher::" + watcherid)
+        records = [self.handler.decode_read("map", record) for record in pipe.execute()]
+        return [record for record in records if len(record) > 0]
+
+    def _get_legacy_watchers(self):
+        """Reads the old watchers string as records while the watcher migration hasn't finished"""
+        if not self.collection.migrations.pending(SCHEMA_WATCHER_RECORDS):
+            return []
+        raw_watchers = self.handler.get("watchers", "")
+        records = [dict(zip(WATCHER_FIELDS, x.split(","))) for x in raw_watchers.split(":") if x != ""]
+        countries = {}
+        for record in records:
+            if record["userid"] not in countries:
+                countries[record["userid"]] = self.collection.country.get_country(record["userid"])
+            record["cc"] = countries[record["userid"]]
+        return records
+
+    def _merge_legacy(self, records, legacy):
+        watcherids = {record["watcherid"] for record in records}
+        return records + [record for record in legacy if record["watcherid"] not in watcherids]
+
+    def get_games(self):
+        """Gets every (appid, cc) pair with watchers"""
+        games = {tuple(game.split("::")) for game in self.handler.get_members("games::set")}
+        games.update((record["gameid"], record["cc"]) for record in self._get_legacy_watchers())
+        return sorted(games)
+
+    def get_watcher_records(self, games=None):
+        """Gets every watcher, or the watchers of the given (appid, cc) pairs, as dicts of WATCHER_FIELDS,
+        in at most three round trips whatever the number of watchers"""
+        if games is None:
+            games = [tuple(game.split("::")) for game in self.handler.get_members("games::set")]
+            legacy = self._get_legacy_watchers()
+        else:
+            legacy = [record for record in self._get_legacy_watchers() if (record["gameid"], record["cc"]) in games]
+        watcherids = set()
+        for ids in self.handler.get_members_many(["game::" + appid + "::" + cc + "::set" for appid, cc in games]):
+            watcherids.update(ids)
+        return self._merge_legacy(self._get_records(sorted(watcherids, key=int)), legacy)
 
-    def set_old(self, old):
-        self.handler["old"] = ":".join(str(x) + "," + str(y) for (x, y) in old.items())
+    def get_game_watchers(self, gameid, cc):
+        return self._get_records(self.handler.get_members("game::" + str(gameid) + "::" + cc + "::set"))
 
-    def get_watcher_game_name(self, gameid):
-        if "gamename::" + str(gameid) in self.handler:
-            return self.handler["gamename::" + str(gameid)].decode("utf-8")
-        return str(gameid)
+    def get_user_watchers(self, userid):
+        records = self._get_records(self.handler.get_members("user::" + str(userid) + "::set"))
+        legacy = [record for record in self._get_legacy_watchers() if record["userid"] == userid]
+        return self._merge_legacy(records, legacy)
 
     def get_watchers(self):
-        if "watchers" in self.handler:
-            raw_watchers = self.handler["watchers"].decode("utf-8")
-            return [x.split(",") for x in raw_watchers.split(":") if x != ""]
-        return []
+        return [[record[field] for field in WATCHER_FIELDS[:-1]] for record in self.get_watcher_records()]
 
     def get_watcher_id(self, user):
-        watcherid = 0
-        if "watcherid" in self.handler:
-            watcherid = int(self.handler["watcherid"].decode("utf-8"))
-
-        if "watcherid::" + str(user) in self.handler:
-            return int(self.handler["watcherid::" + str(user)].decode("utf-8")), watcherid
-        return 0, watcherid
+        watcher_number = len(self.handler.get_members("user::" + str(user) + "::set"))
+        return watcher_number, int(self.handler.get("watcherid", "0"))
 
     def add_watcher(self, userid, locationid, locationtype, percent, gameid, gamename=None):
-        watcher_number, watcherid = self.get_watcher_id(userid)
-        if watcher_number >= self.collection.sdata.WATCHER_CAP:
-            return -1
-
-        watchers = self.get_watchers()
-        if any(x[0] == userid and x[2] == locationid and x[-1] == gameid for x in watchers):
-            return -2
-        watcher = (userid, watcherid, locationid, locationtype, percent, gameid)
-        print("new watcher: %s" % str(watcher))
-        watchers.append(watcher)
-        new_watchers = ":".join(",".join(str(x) for x in watcher) for watcher in watchers)
-        self.handler["watchers"] = new_watchers
-
-        self.handler["watcherid::" + str(userid)] = str(watcher_number + 1)
-        self.handler["watcherid"] = str(watcherid + 1)
+        legacy = self._get_legacy_watchers()
+        if len(legacy) > 0:
+            if any(x["userid"] == userid and x["locationid"] == locationid and x["gameid"] == gameid for x in legacy):
+                return -2
+            if len(self.get_user_watchers(userid)) >= self.collection.sdata.WATCHER_CAP:
+                return -1
+
+        cc = self.collection.country.get_country(userid)
+        watcherid = self._add_watcher(args=[self.handler.name, userid, locationid, locationtype, percent, gameid, cc,
+                                            self.collection.sdata.WATCHER_CAP])
+        if watcherid < 0:
+            return watcherid
+        print("new watcher: %s" % str((userid, watcherid, locationid, locationtype, percent, gameid, cc)))
 
         if gamename is not None:
             self.handler["gamename::" + gameid] = gamename
         return watcherid
 
     def remove_watcher(self, userid, watcherid):
+        if self._remove_watcher(args=[self.handler.name, userid, str(watcherid)]) == 1:
+            return True
 
-        watchers = self.get_watchers()
-        new_watchers = [watcher for watcher in watchers if not (watcher[0] == userid and watcher[1] == watcherid)]
-        if len(watchers) == len(new_watchers):
-            return False
+        if self.collection.migrations.pending(SCHEMA_WATCHER_RECORDS):
+            watchers = [x.split(",") for x in self.handler.get("watchers", "").split(":") if x != ""]
+            new_watchers = [watcher for watcher in watchers if not (watcher[0] == userid and watcher[1] == str(watcherid))]
+            if len(watchers) != len(new_watchers):
+                self.handler["watchers"] = ":".join(",".join(watcher) for watcher in new_watchers)
+                return True
+        return False
 
-        self.handler["watchers"] = ":".join(",".join(str(x) for x in watcher) for watcher in new_watchers)
-        return True
+    def migrate_watchers_key(self, rediskey):
+        raw_watchers = self.handler.get("watchers", "")
+        prefix = self.handler.name + "::"
+        records = [dict(zip(WATCHER_FIELDS, x.split(","))) for x in raw_watchers.split(":") if x != ""]
+        countries = self.collection.country.get_countries([record["userid"] for record in records])
+        pipe = self.handler.redis.pipeline()
+        for record in records:
+            record["cc"] = countries[record["userid"]]
+            watcherid = record["watcherid"]
+            pipe.hmset(prefix + "watcher::" + watcherid, record)
+            pipe.sadd(prefix + "user::" + record["userid"] + "::set", watcherid)
+            pipe.hset(prefix + "user::" + record["userid"] + "::map", record["locationid"] + "::" + record["gameid"], watcherid)
+            pipe.sadd(prefix + "game::" + record["gameid"] + "::" + record["cc"] + "::set", watcherid)
+            pipe.sadd(prefix + "games::set", record["gameid"] + "::" + record["cc"])
+        pipe.delete(rediskey)
+        pipe.execute()
 
     @asyncio.coroutine
-    def check_watchers(self, optional_test=None):
+    def check_watchers(self, optional_test=None, games=None):
+        """Checks the watchers of every game, or only of the given (appid, cc) pairs (see WatcherScheduler),
+        notifying anyone whose watched discount changed"""
         if optional_test is None:
             optional_test = {}
-        old = self.get_old()
+        old = yield from self.run_async("get_old", games)
         print("old: %s" % old)
+        watchers = yield from self.run_async("get_watcher_records", games)
         result_pack = yield from self.collection.steamsearch.check_game_sales([
-                                                                     (watcher[-1], watcher[-2], self.collection.country.get_country(watcher[0]),
-                                                                      watcher[0], watcher[1], watcher[2], watcher[3])
-                                                                     for watcher in self.get_watchers()
+                                                                     (watcher["gameid"], watcher["percent"], watcher["cc"],
+                                                                      watcher["userid"], watcher["watcherid"],
+                                                                      watcher["locationid"], watcher["locationtype"])
+                                                                     for watcher in watchers
                                                                      ], old, optional_test)
         results, new_old = result_pack
 
-        game_names = {}
+        # every name and language the lines need, read off the loop in one go
+        game_names = yield from self.run_async("get_watcher_game_names", {result[0] for result in results})
+        languages = yield from self.collection.languages.run_async("get_languages", {result[5] for result in results})
+        notifications = OrderedDict()  # destination -> lines
         #  result: gameid, check_percent, old_percent, price_overview, name, userid, watcherid, locationid, locationtype
         for result in results:
             gameid, check_percent, old_percent, price_overview, name, userid, watcherid, locationid, locationtype = result
             print("price overview: %s" % price_overview)
             new_percent = price_overview["discount_percent"]
-            if gameid not in game_names:
-                game_names[gameid] = self.get_watcher_game_name(gameid)
             game_name = game_names[gameid]
-            lang = self.collection.language.get_language(userid)
+            lang = languages[userid]
             if new_percent > old_percent:
                 if old_percent == 0:
                     line = lang.get_message("deal_started") % (game_name, str(new_percent) + "%")
@@ -218,300 +1074,835 @@ class WatcherRedis:
             line = "[" + str(watcherid) + "]:  " + line
             if locationtype == "mention":
                 line += "  <@" + userid + ">"
+            notifications.setdefault(self.notifications.destination(locationtype, locationid), []).append(line)
+
+        yield from self.notifications.dispatch(notifications)
+        print("new old: %s" % new_old)
+        yield from self.run_async("set_old", new_old, old)
+
+
+class RateLimiter:
+    """A token bucket allowing rate acquisitions every per seconds, acquire waits until one is available"""
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.allowance = rate
+        self.last = time.time()
+
+    @asyncio.coroutine
+    def acquire(self):
+        while True:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate / self.per)
+            self.last = now
+            if self.allowance >= 1:
+                self.allowance -= 1
+                return
+            yield from asyncio.sleep((1 - self.allowance) * self.per / self.rate)
+
+
+class NotificationDispatcher:
+    """Sends watcher notifications, packing the lines for each destination in to as few messages as possible.
+    Up to concurrency destinations are sent to at once, each rate limited on its own and all of them together."""
+    def __init__(self, client, concurrency=NOTIFICATION_CONCURRENCY, destination_rate=NOTIFICATION_DESTINATION_RATE,
+                 global_rate=NOTIFICATION_GLOBAL_RATE):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.destination_rate = destination_rate
+        self.limiters = {}  # (route, locationid) -> RateLimiter, for destinations sent to recently
+        self.global_limiter = RateLimiter(*global_rate)
+        self.sent = 0
+        self.failed = 0
 
-            if locationtype == "pm":
-                destination = discord.utils.get(self.collection.client.get_all_members(), id=locationid)
-                if destination is None:
-                    destination = yield from self.collection.client.get_user_info(locationid)
+    @staticmethod
+    def coalesce(lines, limit=NOTIFICATION_MESSAGE_LIMIT):
+        """Joins lines in to messages no longer than limit, cutting down any line which is too long on its own"""
+        messages = []
+        current = ""
+        for line in lines:
+            line = line[:limit]
+            if current != "" and len(current) + 1 + len(line) > limit:
+                messages.append(current)
+                current = line
             else:
-                destination = discord.Object(locationid)
+                current = current + "\n" + line if current != "" else line
+        if current != "":
+            messages.append(current)
+        return messages
 
-            yield from self.collection.client.send_message(destination, line)
-        print("new old: %s" % new_old)
-        self.set_old(new_old)
+    @staticmethod
+    def destination(locationtype, locationid):
+        """Gets the (route, locationid) a watcher's notifications go to, mentions are sent in the channel so they share
+        its messages"""
+        return ("pm" if locationtype == "pm" else "channel"), locationid
 
+    @asyncio.coroutine
+    def dispatch(self, notifications):
+        """Sends notifications, a dict mapping each destination (see destination) to the lines to send there"""
+        # limiters idle for longer than their period are full again, so there's no need to keep them
+        now = time.time()
+        self.limiters = {destination: limiter for destination, limiter in self.limiters.items()
+                         if now - limiter.last < limiter.per}
+        if len(notifications) > 0:
+            yield from asyncio.gather(*[self._send(route, locationid, lines)
+                                        for (route, locationid), lines in notifications.items()])
 
-class PremiumRedis:
+    @asyncio.coroutine
+    def _send(self, route, locationid, lines):
+        with (yield from self.semaphore):
+            try:
+                if route == "pm":
+                    destination = discord.utils.get(self.client.get_all_members(), id=locationid)
+                    if destination is None:
+                        destination = yield from self.client.get_user_info(locationid)
+                else:
+                    destination = discord.Object(locationid)
+
+                if (route, locationid) not in self.limiters:
+                    self.limiters[(route, locationid)] = RateLimiter(*self.destination_rate)
+                limiter = self.limiters[(route, locationid)]
+                for message in self.coalesce(lines):
+                    yield from limiter.acquire()
+                    yield from self.global_limiter.acquire()
+                    yield from self.client.send_message(destination, message)
+                    self.sent += 1
+            except Exception:
+                print("failed to send watcher notifications to %s %s" % (route, locationid))
+                traceback.print_exc()
+                self.failed += 1
+
+
+class WatcherScheduler:
+    """Spreads the watcher checks evenly over an interval instead of checking everything at once. Each interval
+    the watched (appid, cc) pairs are split in to slices which run at even steps through it, pairs close to their
+    region's price rollover first. A slice checks at most slice_budget pairs, anything left over goes first next time.
+
+    Schedule run() once on the event loop, in place of calling check_watchers periodically.
+    """
+    def __init__(self, watcher, interval=WATCHER_CHECK_INTERVAL, slices=WATCHER_SLICES, slice_budget=WATCHER_SLICE_BUDGET):
+        self.watcher = watcher # type: WatcherRedis
+        self.interval = interval
+        self.slices = slices
+        self.slice_budget = slice_budget
+        self.carried = []
+
+        self.cycles = 0
+        self.slices_run = 0
+        self.checked = 0
+        self.total_lag = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.last_slice_seconds = 0.0
+        self.max_slice_seconds = 0.0
+
+    def near_rollover(self, cc, now):
+        rollover = self.watcher.collection.steamsearch.next_price_rollover(cc, now)
+        return rollover - now < WATCHER_ROLLOVER_WINDOW or now - (rollover - 86400) < WATCHER_ROLLOVER_WINDOW
+
+    def prioritise(self, games, now):
+        """Orders (appid, cc) pairs with anything carried over first, then pairs near their rollover"""
+        near = {}
+        for appid, cc in games:
+            if cc not in near:
+                near[cc] = self.near_rollover(cc, now)
+        # games stays a list for its order, the set is only for membership tests
+        game_set = set(games)
+        carried = [game for game in self.carried if game in game_set]
+        carried_set = set(carried)
+        rest = [game for game in games if game not in carried_set]
+        return carried + sorted(rest, key=lambda game: not near[game[1]])
+
+    @asyncio.coroutine
+    def run_cycle(self):
+        start = time.time()
+        games = yield from self.watcher.run_async("get_games")
+        queue = self.prioritise(games, start)
+        slice_length = self.interval / self.slices
+        for i in range(self.slices):
+            scheduled = start + i * slice_length
+            if scheduled > time.time():
+                yield from asyncio.sleep(scheduled - time.time())
+            lag = time.time() - scheduled
+
+            count = min(self.slice_budget, int(math.ceil(len(queue) / (self.slices - i))))
+            batch, queue = queue[:count], queue[count:]
+            slice_start = time.time()
+            if len(batch) > 0:
+                try:
+                    yield from self.watcher.check_watchers(games=batch)
+                except Exception:
+                    traceback.print_exc()
+            self._record_slice(lag, time.time() - slice_start, len(batch))
+
+        self.carried = queue
+        self.cycles += 1
+        if start + self.interval > time.time():
+            yield from asyncio.sleep(start + self.interval - time.time())
+
+    @asyncio.coroutine
+    def run(self):
+        """Runs cycles forever. A cycle which fails outside a slice's checks (reading the games from redis, say) is
+        logged and the next one starts a slice later, rather than watcher checks stopping for good"""
+        while True:
+            try:
+                yield from self.run_cycle()
+            except Exception:
+                print("watcher cycle failed")
+                traceback.print_exc()
+                yield from asyncio.sleep(self.interval / self.slices)
+
+    def _record_slice(self, lag, seconds, checked):
+        self.slices_run += 1
+        self.checked += checked
+        self.total_lag += lag
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.last_slice_seconds = seconds
+        self.max_slice_seconds = max(self.max_slice_seconds, seconds)
+
+    def stats(self):
+        """Gets the scheduler's metrics
+
+        Returns:
+            a dict containing cycles, slices, checked, carried (pairs waiting for the next interval), last_lag,
+            mean_lag and max_lag (seconds slices started late by) and last_slice and max_slice (seconds slices took)
+        """
+        return {
+            "cycles": self.cycles,
+            "slices": self.slices_run,
+            "checked": self.checked,
+            "carried": len(self.carried),
+            "last_lag": self.last_lag,
+            "mean_lag": self.total_lag / self.slices_run if self.slices_run > 0 else 0.0,
+            "max_lag": self.max_lag,
+            "last_slice": self.last_slice_seconds,
+            "max_slice": self.max_slice_seconds
+        }
+
+
+class PremiumRedis(RedisHelper):
+    """Premium users are stored in the users::set set, with a version stamp bumped on every change. Each shard keeps
+    a frozenset copy, reloaded when another shard publishes a new version or the stamp is found to have moved"""
     def __init__(self, collection):
         self.handler = RedisHandler("premium", collection.redis_server)
         self.collection = collection # type: RedisCollection
+        self.users = None
+        self.version = None
+        self.last_check = 0
+        collection.subscribe("premium::invalidate", self.invalidate)
+        collection.migrations.register(SCHEMA_PREMIUM_SET, "premium users string to set",
+                                       self.handler.name + "::users", self.migrate_users_key)
+
+    def invalidate(self, version=None):
+        if version is None or version != self.version:
+            self.users = None
+
+    def _changed(self, pipe):
+        pipe.incr(self.handler.name + "::version")
+        version = str(pipe.execute()[-1])
+        self.users = None
+        self.collection.publish("premium::invalidate", version)
 
     def get_premium_users(self):
-        if "users" in self.handler:
-            return self.handler["users"].decode("utf-8").split(",")
-        return []
+        """Gets the local snapshot of the premium users, only touching redis if it's been invalidated
+        or every PREMIUM_CHECK_INTERVAL seconds to compare the version stamp"""
+        if self.users is not None and time.time() - self.last_check > PREMIUM_CHECK_INTERVAL:
+            self.last_check = time.time()
+            if self.handler.get("version") != self.version:
+                self.users = None
+        if self.users is None:
+            pipe = self.handler.redis.pipeline()
+            pipe.get(self.handler.name + "::version")
+            pipe.smembers(self.handler.name + "::users::set")
+            if self.collection.migrations.pending(SCHEMA_PREMIUM_SET):
+                pipe.get(self.handler.name + "::users")
+            version, users, *legacy = pipe.execute()
+            self.version = version.decode("utf-8") if version is not None else None
+            users = {user.decode("utf-8") for user in users}
+            if len(legacy) > 0 and legacy[0] is not None:
+                users.update(user for user in legacy[0].decode("utf-8").split(",") if user != "")
+            self.users = frozenset(users)
+            self.last_check = time.time()
+        return self.users
+
+    def is_premium(self, userid):
+        return userid in self.get_premium_users()
 
     def add_premium_users(self, users):
-        users += self.get_premium_users()
-        self.handler["users"] = ",".join(users)
+        if len(users) > 0:
+            pipe = self.handler.redis.pipeline()
+            pipe.sadd(self.handler.name + "::users::set", *users)
+            self._changed(pipe)
+
+    def _convert(self):
+        # moves the old joined string in to the set before a removal, so the migration can't bring the users back
+        if self.collection.migrations.pending(SCHEMA_PREMIUM_SET):
+            self.migrate_users_key((self.handler.name + "::users").encode("utf-8"))
+
+    def remove_premium_users(self, users):
+        if len(users) > 0:
+            self._convert()
+            pipe = self.handler.redis.pipeline()
+            pipe.srem(self.handler.name + "::users::set", *users)
+            self._changed(pipe)
 
     def set_premium_users(self, users):
-        self.handler["users"] = ",".join(users)
+        self._convert()
+        pipe = self.handler.redis.pipeline()
+        pipe.delete(self.handler.name + "::users::set")
+        if len(users) > 0:
+            pipe.sadd(self.handler.name + "::users::set", *users)
+        self._changed(pipe)
+
+    def update_member(self, member):
+        """Brings one member's premium status in line with their roles, call it from the member update event.
+        Only writes to redis if it changed
+
+        Returns:
+            whether the member is premium (bool)
+        """
+        premium = any(role.id in PREMIUM_ROLES for role in getattr(member, "roles", []))
+        if premium != self.is_premium(member.id):
+            if premium:
+                self.add_premium_users([member.id])
+            else:
+                self.remove_premium_users([member.id])
+        return premium
+
+    def remove_member(self, member):
+        """Takes premium away from a member who left the server, call it from the member remove event (the member
+        passed to it still has their roles, so update_member would keep them premium). Only writes to redis if
+        they were premium"""
+        if self.is_premium(member.id):
+            self.remove_premium_users([member.id])
+
+    def migrate_users_key(self, rediskey):
+        users = self.handler.get("users")
+        if users is not None:
+            users = [user for user in users.split(",") if user != ""]
+            pipe = self.handler.redis.pipeline()
+            if len(users) > 0:
+                pipe.sadd(self.handler.name + "::users::set", *users)
+            pipe.delete(rediskey)
+            self._changed(pipe)
 
     def update_premium_users(self, server):
-        premium_roles = ["209743495064322049", "220107636878737409", "254044942962393088",
-                         "229660520842526730", "229663214332411904"]
+        """Full resync from every member of the server, only needed at startup or after events were missed"""
         premium_members = [member.id for member in server.members if
-                           any(role.id in premium_roles for role in member.roles)]
+                           any(role.id in PREMIUM_ROLES for role in member.roles)]
         self.set_premium_users(premium_members)
         return premium_members
 
 
-class BillboardRedis:
+class BillboardRedis(RedisHelper):
     def __init__(self, collection):
         self.handler = RedisHandler("billboard", collection.redis_server)
         self.collection = collection
+        collection.migrations.register(SCHEMA_BILLBOARD_NATIVE, "billboard strings to hash and sets",
+                                       self.handler.name + "::*", self.migrate_key)
+
+    def _legacy(self, field):
+        """Reads one of the old joined strings if the billboard migration hasn't finished, None otherwise"""
+        if self.collection.migrations.pending(SCHEMA_BILLBOARD_NATIVE):
+            return self.handler.get(field)
+        return None
+
+    def _convert(self, field):
+        """Moves one of the old joined strings in to the new layout before a write, if the billboard migration hasn't
+        finished, so the migration can't bring back anything the write removes"""
+        if self.collection.migrations.pending(SCHEMA_BILLBOARD_NATIVE):
+            self.migrate_key((self.handler.name + "::" + field).encode("utf-8"))
 
     def get_billboard_curators(self):
-        if "curators" in self.handler:
-            return self.handler["curators"].decode("utf-8").split(",")
-        return []
+        curators = self.handler.get_members("curators::set")
+        legacy = self._legacy("curators")
+        if legacy is not None:
+            curators.update(curator for curator in legacy.split(",") if curator != "")
+        return list(curators)
 
     def set_billboard_curators(self, curators):
-        self.handler["curators"] = ",".join(curators)
+        self._convert("curators")
+        self.handler.replace_members("curators::set", curators)
 
     def remove_billboard_curators(self, users):
         if not isinstance(users, list) and not isinstance(users, tuple): users = [users]
-        curators = self.get_billboard_curators()
-        for user in users:
-            if user in curators: curators.remove(user)
-        self.set_billboard_curators(curators)
+        self._convert("curators")
+        self.handler.remove_members("curators::set", users)
 
     def add_billboard_curators(self, user):
-        curators = self.get_billboard_curators()
-        if user not in curators: curators.append(user)
-        self.set_billboard_curators(curators)
+        self.handler.add_members("curators::set", [user])
 
     def get_billboard_posts(self):
-        if "posts" in self.handler:
-            posts = [x.split("=") for x in self.handler["posts"].decode("utf-8").split(";")]
-            return {x: y for x, y in posts}
-        return {}
+        posts = self.handler.get_map("posts::map")
+        legacy = self._legacy("posts")
+        if legacy is not None:
+            for x, y in [post.split("=") for post in legacy.split(";") if post != ""]:
+                posts.setdefault(x, y)
+        return posts
 
     def set_billboard_posts(self, posts):
-        posts = ";".join("%s=%s" % (x, y) for x, y in posts.items())
-        self.handler["posts"] = posts
+        self._convert("posts")
+        self.handler.replace_map("posts::map", posts)
 
     def add_billboard_post(self, post, msgids):
-        posts = self.get_billboard_posts()
-        posts[post] = msgids
-        self.set_billboard_posts(posts)
+        self.handler.set_map_items("posts::map", {post: msgids})
 
     def remove_billboard_post(self, post):
-        posts = self.get_billboard_posts()
-        if post in posts:
-            del posts[post]
-        self.set_billboard_posts(posts)
+        self._convert("posts")
+        self.handler.delete_map_items("posts::map", [post])
 
     def get_billboard_channels(self):
-        if "channels" in self.handler:
-            return self.handler["channels"].decode("utf-8").split(",")
-        return []
+        channels = self.handler.get_members("channels::set")
+        legacy = self._legacy("channels")
+        if legacy is not None:
+            channels.update(channel for channel in legacy.split(",") if channel != "")
+        return list(channels)
 
     def set_billboard_channels(self, channels):
-        self.handler["channels"] = ",".join(channels)
+        self._convert("channels")
+        self.handler.replace_members("channels::set", channels)
 
     def add_billboard_channel(self, channel):
-        channels = self.get_billboard_channels()
-        if channel not in channels: channels.append(channel)
-        self.set_billboard_channels(channels)
+        self.handler.add_members("channels::set", [channel])
 
     def get_billboard_postid(self):
-        if "postid" in self.handler:
-            return int(self.handler["postid"].decode("utf-8"))
-        return 0
+        return int(self.handler.get("postid", "0"))
 
     def set_billboard_postid(self, postid):
         self.handler["postid"] = str(postid)
 
+    def next_billboard_postid(self):
+        """Atomically takes the next post id, so shards posting at the same time never get the same one"""
+        return self.handler.redis.incr(self.handler.name + "::postid")
+
     def remove_billboard_channel(self, channel):
-        channels = self.get_billboard_channels()
-        if channel in channels: channels.remove(channel)
-        self.set_billboard_channels(channels)
+        self._convert("channels")
+        self.handler.remove_members("channels::set", [channel])
 
+    def migrate_key(self, rediskey):
+        field = rediskey.decode("utf-8")[len(self.handler.name + "::"):]
+        if field not in ("posts", "curators", "channels"):
+            return
+        value = self.handler.get(field)
+        if value is None:
+            return
+        pipe = self.handler.redis.pipeline()
+        if field == "posts":
+            posts = {x: y for x, y in [post.split("=") for post in value.split(";") if post != ""]}
+            for post, msgids in posts.items():
+                pipe.hsetnx(self.handler.name + "::posts::map", post, msgids)
+        else:
+            members = [member for member in value.split(",") if member != ""]
+            if len(members) > 0:
+                pipe.sadd(self.handler.name + "::" + field + "::set", *members)
+        pipe.delete(rediskey)
+        pipe.execute()
 
-class PermissionRedis:
+
+class PermissionRedis(RedisHelper):
     def __init__(self, collection):
         self.handler = RedisHandler("permissions", collection.redis_server)
         self.collection = collection
+        collection.migrations.register(SCHEMA_PERMISSION_SETS, "indexed permission lists to sets",
+                                       self.handler.name + "::*::length", self.migrate_length_key)
+        collection.migrations.register(SCHEMA_PERMISSION_CLEANUP, "delete orphaned permission index keys",
+                                       self.handler.name + "::*::*", self.migrate_index_key)
 
-    def get_permissions(self, key, id, server=True):
-        dbkey = key + "::" + ("server" if server else "channel") + "::" + id
-        if dbkey + "::length" in self.handler:
-            length = int(self.handler[dbkey + "::length"].decode("utf-8"))
-            return [self.handler[dbkey + "::" + str(i)].decode("utf-8") for i in range(length)]
-        return []
+    @staticmethod
+    def _set_key(key, id, server=True):
+        return key + "::" + ("server" if server else "channel") + "::" + id + "::set"
+
+    def prefetch(self, batch, msg, key):
+        if msg.server is not None:
+            batch.get_members(self.handler, self._set_key(key, msg.server.id, True))
+        batch.get_members(self.handler, self._set_key(key, msg.channel.id, False))
+
+    def _with_legacy(self, permissions, key, id, server):
+        """Adds the old indexed list's permissions if the set migration hasn't finished"""
+        if self.collection.migrations.pending(SCHEMA_PERMISSION_SETS):
+            legacy = self.handler.get_indexed(key + "::" + ("server" if server else "channel") + "::" + id, [])
+            if isinstance(legacy, list):
+                permissions = permissions | set(legacy)
+        return sorted(permissions)
+
+    def _convert(self, key, id, server):
+        """Moves the old indexed list in to the set before a removal, if the set migration hasn't finished, so the
+        migration can't bring back the removed permissions"""
+        if self.collection.migrations.pending(SCHEMA_PERMISSION_SETS):
+            dbkey = key + "::" + ("server" if server else "channel") + "::" + id
+            self.migrate_length_key((self.handler.name + "::" + dbkey + "::length").encode("utf-8"))
+
+    def get_permissions(self, key, id, server=True, ctx=None):
+        permissions = self.handler.get_members(self._set_key(key, id, server), memo=_memo(ctx))
+        return self._with_legacy(permissions, key, id, server)
+
+    def get_all_permissions(self, key, serverid, channelid, ctx=None):
+        """Gets the permissions of a command for a server and a channel together in one round trip"""
+        server_perms, channel_perms = self.handler.get_members_many(
+            [self._set_key(key, serverid, True), self._set_key(key, channelid, False)], memo=_memo(ctx))
+        return self._with_legacy(server_perms, key, serverid, True) + \
+            self._with_legacy(channel_perms, key, channelid, False)
 
     def add_permissions(self, key, permissions, id, server=True):
-        dbkey = key + "::" + ("server" if server else "channel") + "::" + id
-        length = 0
-        if dbkey + "::length" in self.handler:
-            length = int(self.handler[dbkey + "::length"].decode("utf-8"))
-            self.handler[dbkey + "::length"] = str(length + len(permissions))
-        for i, permission in enumerate(permissions):
-            self.handler[dbkey + "::" + str(length + i)] = permission
+        return self.handler.add_members(self._set_key(key, id, server), permissions)
 
     def clear_permissions(self, key, id, server=True):
-        dbkey = key + "::" + ("server" if server else "channel") + "::" + id
-        self.handler[dbkey + "::length"] = "0"
+        self._convert(key, id, server)
+        del self.handler[self._set_key(key, id, server)]
 
     def remove_permissions(self, key, permissions, id, server=True):
-        dbkey = key + "::" + ("server" if server else "channel") + "::" + id
-        perms = self.get_permissions(key, id, server)
-        j = 0
-        removed = []
-        for perm in perms:
-            if perm not in permissions:
-                self.handler[dbkey + "::" + str(j)] = perm
-                j += 1
-            else:
-                removed.append(perm)
-        self.handler[dbkey + "::length"] = str(j)
-        return removed
-
-
-class LanguageRedis:
+        self._convert(key, id, server)
+        return self.handler.remove_members(self._set_key(key, id, server), permissions)
+
+    def migrate_length_key(self, rediskey):
+        prefix = self.handler.name + "::"
+        dbkey = rediskey.decode("utf-8")[len(prefix):-len("::length")]
+        permissions = self.handler.get_indexed(dbkey, [])
+        pipe = self.handler.redis.pipeline()
+        if isinstance(permissions, list) and len(permissions) > 0:
+            pipe.sadd(prefix + dbkey + "::set", *permissions)
+        pipe.delete(rediskey)
+        pipe.execute()
+
+    def migrate_index_key(self, rediskey):
+        parts = rediskey.decode("utf-8").split("::")
+        if len(parts) >= 5 and parts[-3] in ("server", "channel") and parts[-1].isdigit():
+            self.handler.redis.delete(rediskey)
+
+
+class LanguageRedis(RedisHelper):
     def __init__(self, collection):
         self.handler = RedisHandler("languages", collection.redis_server)
+        self.version_handler = RedisHandler("languageshub", collection.redis_server)
         self.collection = collection
+        self._seen_versions = {}
+        collection.subscribe("languageshub::version", self.versions_changed)
+
+    def versions_changed(self, names=None):
+        """Called on the loop when a shard publishes new version stamps (or the listener reconnected, with None),
+        checks them in the executor as that reads redis and the language files"""
+        self.collection.loop.run_in_executor(REDIS_EXECUTOR, self.check_language_versions)
 
     def load_language(self, name, backup=None):
         language = Language.load_language(name, backup=backup)
         self.collection.sdata.languages[name] = language
+        self.version_handler[name + "::version"] = language.version
+        self._seen_versions[name] = language.version
+        self.collection.publish("languageshub::version", name)
         return language
 
+    def check_language_versions(self):
+        """Reloads the languages whose version stamp was changed by another shard loading newer files.
+        Shards publish on languageshub::version when they change a stamp, which runs this on every shard."""
+        languages = self.collection.sdata.languages
+        names = list(languages.keys())
+        stamps = self.version_handler.get_many([name + "::version" for name in names])
+        changed = [name for name, stamp in zip(names, stamps)
+                   if stamp is not None and stamp != languages[name].version and stamp != self._seen_versions.get(name)]
+        for name, stamp in zip(names, stamps):
+            self._seen_versions[name] = stamp
+        if len(changed) == 0:
+            return []
+
+        english = languages["english"]
+        if "english" in changed:
+            english = Language.load_language("english") or english
+            languages["english"] = english
+        for name in names:
+            if name == "english":
+                continue
+            if name in changed and os.path.exists("languages/" + name + ".json"):
+                languages[name] = Language.load_language(name, backup=english)
+            elif languages[name].backup is not english:
+                languages[name].backup = english
+                languages[name].resolve()
+        print("reloaded languages: " + str(changed))
+        return changed
+
     def load_all_languages(self):
+        """Loads every language file, skipping any whose contents haven't changed since they were last loaded,
+        then writes all the version stamps that changed in one MSET
+
+        Returns:
+            a dict mapping each language name to the seconds it took to load (0 for unchanged ones)
+        """
+        languages = self.collection.sdata.languages
         onlyfiles = [f for f in os.listdir("languages/") if os.path.isfile(os.path.join("languages/", f))]
-        loaded = []
-        english = self.load_language("english")
-        loaded.append(english)
-        for filename in onlyfiles:
-            if not filename.startswith("english"):
-                if filename.endswith(".json"):
-                    lang = filename[:-5]
-                    self.load_language(lang, backup=english)
-                    loaded.append(lang)
-        print("loaded languages: " + str(loaded))
-
-    def get_language(self, userid, serverid=None):
-        if userid in self.handler:
-            return self.collection.sdata.languages[self.handler[userid].decode("utf-8")]
-        elif serverid is not None and "server::" + serverid in self.handler:
-            return self.collection.sdata.languages[self.handler["server::" + serverid].decode("utf-8")]
-        else:
-            return self.collection.sdata.languages["english"]
+        names = ["english"] + sorted(f[:-5] for f in onlyfiles if f.endswith(".json") and not f.startswith("english"))
+
+        timings = {}
+        english = None
+        for name in names:
+            start = time.time()
+            with open("languages/" + name + ".json", "rb") as f:
+                raw = f.read()
+            version = hashlib.sha1(raw).hexdigest()
+            current = languages.get(name)
+            if current is not None and current.version == version:
+                if current.backup is not english:
+                    current.backup = english
+                    current.resolve()
+                timings[name] = 0
+            else:
+                languages[name] = Language(name, json.loads(raw.decode("utf-8")), backup=english, version=version)
+                timings[name] = time.time() - start
+            if name == "english":
+                english = languages[name]
+
+        stamps = self.version_handler.get_many([name + "::version" for name in names])
+        changed = {name + "::version": languages[name].version
+                   for name, stamp in zip(names, stamps) if stamp != languages[name].version}
+        self.version_handler.set_many(changed)
+        for name in names:
+            self._seen_versions[name] = languages[name].version
+        if len(changed) > 0:
+            self.collection.publish("languageshub::version", ",".join(name for name in names
+                                                                         if name + "::version" in changed))
+
+        print("loaded languages: " + ", ".join("%s (%s)" % (name, "%.1fms" % (timings[name] * 1000) if timings[name] else "unchanged")
+                                               for name in names))
+        return timings
+
+    def prefetch(self, batch, msg):
+        if msg.server is not None:
+            batch.get(self.handler, "server::" + msg.server.id)
+
+    def get_language(self, userid, serverid=None, ctx=None):
+        language = self.collection.settings.get(userid, "language", ctx=ctx)
+        if language is None and serverid is not None:
+            language = self.handler.get("server::" + serverid, memo=_memo(ctx))
+        return self.collection.sdata.languages[language or "english"]
+
+    def get_languages(self, userids):
+        """Gets the languages of several users at once (without server fallbacks), as a dict mapping userid to Language"""
+        languages = self.collection.settings.get_many(userids, "language")
+        return {userid: self.collection.sdata.languages[language or "english"] for userid, language in languages.items()}
+
+    @asyncio.coroutine
+    def get_language_async(self, userid, serverid=None, ctx=None):
+        result = yield from run_async(self.get_language, userid, serverid, ctx)
+        return result
 
-    def set_language(self, id, language, server=False):
+    def set_language(self, id, language, server=False, ctx=None):
         if isinstance(language, Language):
             language = language.name
         if server:
             self.handler["server::" + id] = language
+            if ctx is not None:
+                ctx.prefetched.pop((self.handler.name, "get", "server::" + id), None)
         else:
-            self.handler[id] = language
+            self.collection.settings.set_settings(id, {"language": language}, ctx)
 
 
-class CurrencyRedis:
+class CurrencyRedis(RedisHelper):
     def __init__(self, collection):
         self.handler = RedisHandler("currencies", collection.redis_server)
         self.collection = collection
 
-    def get_currency(self, userid):
-        if userid in self.handler:
-            return (self.handler["code::" + userid].decode("utf-8"), self.handler["symbol::" + userid].decode("utf-8"))
+    def get_currency(self, userid, ctx=None):
+        settings = self.collection.settings.get_settings(userid, ctx)
+        if "currency_code" in settings and "currency_symbol" in settings:
+            return settings["currency_code"], settings["currency_symbol"]
         else:
             return "GBP", "£"
 
-    def set_currency(self, userid, code, symbol):
-        self.handler["code::" + userid] = code
-        self.handler["symbol::" + userid] = symbol
+    def set_currency(self, userid, code, symbol, ctx=None):
+        self.collection.settings.set_settings(userid, {"currency_code": code, "currency_symbol": symbol}, ctx)
 
 
-class CountryRedis:
+class CountryRedis(RedisHelper):
     def __init__(self, collection):
         self.handler = RedisHandler("countries", collection.redis_server)
         self.collection = collection
 
-    def get_country(self, userid):
-        if userid in self.handler:
-            return self.handler[userid].decode("utf-8")
-        else:
-            return "gb"
+    def get_country(self, userid, ctx=None):
+        return self.collection.settings.get(userid, "country", "gb", ctx)
+
+    def get_countries(self, userids):
+        """Gets the country of each of several users at once, as a dict mapping userid to country"""
+        return self.collection.settings.get_many(userids, "country", "gb")
 
+    def set_country(self, userid, country, ctx=None):
+        self.collection.settings.set_settings(userid, {"country": country}, ctx)
 
-class NameRedis:
+
+class NameRedis(RedisHelper):
     def __init__(self, collection):
         self.handler = RedisHandler("names", collection.redis_server)
         self.collection = collection
 
     def get_name(self, userid):
-        if userid in self.handler:
-            return self.handler[userid].decode("utf-8")
-        else:
-            return "unknown"
-
-    def get_saved_name(self, ctx, term, marked):
-        if term == "" and ctx.message.author.id in self.handler:
-            return self.handler[ctx.message.author.id].decode("utf-8"), self.collection.marked.get_saved_mark(ctx.message.author.id, marked)
-        elif len(ctx.message.mentions) == 1 and ctx.message.mentions[0].id in self.handler:
-            return self.handler[ctx.message.mentions[0].id].decode("utf-8"), self.collection.marked.get_saved_mark(ctx.message.mentions[0].id,
-                                                                                           marked)
-        else:
-            return term, marked
+        return self.collection.settings.get(userid, "name", "unknown")
 
+    def set_name(self, userid, name, ctx=None):
+        self.collection.settings.set_settings(userid, {"name": name}, ctx)
 
-class MarkedRedis:
+    def get_saved_name(self, ctx, term, marked):
+        userids = []
+        if term == "":
+            userids.append(ctx.message.author.id)
+        if len(ctx.message.mentions) == 1:
+            userids.append(ctx.message.mentions[0].id)
+        for userid in userids:
+            name = self.collection.settings.get(userid, "name", ctx=ctx)
+            if name is not None:
+                return name, self.collection.marked.get_saved_mark(userid, marked, ctx)
+        return term, marked
+
+
+class MarkedRedis(RedisHelper):
     def __init__(self, collection):
         self.handler = RedisHandler("marks", collection.redis_server)
         self.collection = collection
 
-    def get_saved_mark(self, key, marked):
-        if key in self.handler and self.handler[key].decode("utf-8").lower() != "none":
+    def get_saved_mark(self, key, marked, ctx=None):
+        mark = self.collection.settings.get(key, "mark", ctx=ctx)
+        if mark is not None and mark.lower() != "none":
             return True
         return marked
 
 
-class BannedRedis:
-    def __init__(self, collection):
+class BannedRedis(RedisHelper):
+    """Bans are stored as a set of command keys ("*" for everything) per user, channel or server under
+    category::id::set, with an index::set of every category::id that has bans.
+
+    When local_filter is on a copy of the index is kept in memory and checks for anything not in it skip redis
+    entirely, which is almost every message. Every change bumps the version stamp and publishes on
+    global_bans::invalidate so shards drop their copy, and the stamp is compared every BAN_INDEX_CHECK_INTERVAL
+    seconds in case an invalidation was missed."""
+    def __init__(self, collection, local_filter=True):
         self.handler = RedisHandler("global_bans", collection.redis_server)
         self.collection = collection
+        self.local_filter = local_filter
+        self.index = None
+        self.version = None
+        self.last_check = 0
+        self._generation = 0
+        self._remove_bans = self.handler.redis.register_script(REMOVE_INDEXED_MEMBERS_SCRIPT)
+        collection.subscribe("global_bans::invalidate", self.invalidate)
+        collection.migrations.register(SCHEMA_BAN_SETS, "ban strings to sets and index",
+                                       self.handler.name + "::*", self.migrate_key)
+
+    def invalidate(self, data=None):
+        self._generation += 1
+        self.index = None
+
+    def _changed(self, category_id):
+        self.handler.redis.incr(self.handler.name + "::version")
+        self.invalidate()
+        self.collection.publish("global_bans::invalidate", category_id)
+
+    def get_index(self):
+        if self.index is not None and time.time() - self.last_check > BAN_INDEX_CHECK_INTERVAL:
+            self.last_check = time.time()
+            if self.handler.get("version") != self.version:
+                self.invalidate()
+        index = self.index
+        if index is None:
+            generation = self._generation
+            pipe = self.handler.redis.pipeline()
+            pipe.get(self.handler.name + "::version")
+            pipe.smembers(self.handler.name + "::index::set")
+            version, members = pipe.execute()
+            index = frozenset(member.decode("utf-8") for member in members)
+            # an invalidation while loading may be for a change made after the read, so don't keep this copy
+            if generation == self._generation:
+                self.index = index
+                self.version = version.decode("utf-8") if version is not None else None
+                self.last_check = time.time()
+        return index
+
+    def _ban_keys(self, msg):
+        rediskeys = ["user::" + msg.author.id, "channel::" + msg.channel.id]
+        if msg.server is not None:
+            rediskeys.append("server::" + msg.server.id)
+        if self.local_filter and not self.collection.migrations.pending(SCHEMA_BAN_SETS):
+            index = self.get_index()
+            rediskeys = [rediskey for rediskey in rediskeys if rediskey in index]
+        return [rediskey + "::set" for rediskey in rediskeys]
+
+    def get_bans(self, category, id):
+        bans = self.handler.get_members(category + "::" + id + "::set")
+        if self.collection.migrations.pending(SCHEMA_BAN_SETS):
+            bans.update(ban for ban in self.handler.get(category + "::" + id, "").split(";") if ban != "")
+        return bans
 
     def is_banned(self, category, id, key):
-        rediskey = category + "::" + id
-        # print("checking key %s" % )
-        if rediskey in self.handler:
-            keys = self.handler[rediskey].decode("utf-8").split(";")
-            # print("found keys %s under %s" % (keys, rediskey))
-            return key in keys or "*" in keys
-        return False
+        keys = self.get_bans(category, id)
+        return key in keys or "*" in keys
+
+    def add_bans(self, category, id, keys):
+        pipe = self.handler.redis.pipeline()
+        pipe.sadd(self.handler.name + "::index::set", category + "::" + id)
+        pipe.sadd(self.handler.name + "::" + category + "::" + id + "::set", *keys)
+        pipe.incr(self.handler.name + "::version")
+        pipe.execute()
+        self.invalidate()
+        self.collection.publish("global_bans::invalidate", category + "::" + id)
+
+    def remove_bans(self, category, id, keys):
+        if self.collection.migrations.pending(SCHEMA_BAN_SETS):
+            # moves the old string in to the set first, so the migration can't bring the lifted bans back
+            self.migrate_key((self.handler.name + "::" + category + "::" + id).encode("utf-8"))
+        removed = self._remove_bans(keys=[self.handler.name + "::" + category + "::" + id + "::set",
+                                          self.handler.name + "::index::set"], args=[category + "::" + id] + list(keys))
+        self._changed(category + "::" + id)
+        return removed
+
+    def prefetch(self, batch, msg):
+        for rediskey in self._ban_keys(msg):
+            batch.get_members(self.handler, rediskey)
 
     def check_ban(self, ctx, msg, key):
         #if key in self.collection.sdata.valid_commands:
         #    add_stats(commands=1)
+        rediskeys = self._ban_keys(msg)
+        bans = self.handler.get_members_many(rediskeys, memo=_memo(ctx)) if len(rediskeys) > 0 else []
+        if self.collection.migrations.pending(SCHEMA_BAN_SETS):
+            bans += [set(ban.split(";")) for ban in self.handler.get_many([rediskey[:-len("::set")] for rediskey in rediskeys], "")]
         if False and msg.author.id == "141964149356888064":
             return
-        elif self.is_banned("user", msg.author.id, key) or self.is_banned("channel", msg.channel.id, key) or \
-                (msg.server is not None and self.is_banned("server", msg.server.id, key)):
+        elif any(key in keys or "*" in keys for keys in bans):
             raise BannedError
         elif not ctx.check_permissions(key):
             raise CommandPermissionError
 
+    @asyncio.coroutine
+    def check_ban_async(self, ctx, msg, key):
+        yield from run_async(self.check_ban, ctx, msg, key)
+
+    def migrate_key(self, rediskey):
+        prefix = self.handler.name + "::"
+        dbkey = rediskey.decode("utf-8")[len(prefix):]
+        if dbkey.endswith("::set") or dbkey.count("::") != 1:
+            return
+        keys = [key for key in (self.handler.get(dbkey) or "").split(";") if key != ""]
+        pipe = self.handler.redis.pipeline()
+        if len(keys) > 0:
+            pipe.sadd(prefix + "index::set", dbkey)
+            pipe.sadd(prefix + dbkey + "::set", *keys)
+        pipe.delete(rediskey)
+        pipe.incr(prefix + "version")
+        pipe.execute()
+
 
-class RecommendationRedis:
+class RecommendationRedis(RedisHelper):
     def __init__(self, collection):
         self.handler = RedisHandler("recommendations", collection.redis_server)
         self.collection = collection
 
     @asyncio.coroutine
     def get_recommendations(self, appid, timeout=10):
-        if "appid" in self.handler:
-            appids = self.handler["appid"].decode("utf-8").split(",")
+        appids = yield from run_async(self.handler.get, "appid")
+        if appids is not None:
+            appids = appids.split(",")
             last_time = int(appids[0])
             if time.time() - last_time < 1800:
                 return appids[1:]
 
         recommendations = yield from self.collection.steamsearch.get_recommendations(appid, timeout=timeout)
         if len(recommendations) > 0:
-            self.handler["appid"] = str(int(time.time())) + "," + ",".join(recommendations)
+            yield from self.handler.set_async("appid", str(int(time.time())) + "," + ",".join(recommendations))
             return recommendations
         return None
 
@@ -553,26 +1944,22 @@ class RecommendationRedis:
         return new_results, failed
 
 
-class QueryRedis:
+class QueryRedis(RedisHelper):
     def __init__(self, collection):
         self.handler = RedisHandler("queries", collection.redis_server)
         self.collection = collection
 
     def query_in_progress(self):
-        if "in_progress" in self.handler:
-            return self.handler["in_progress"].decode("utf-8") == "true"
-        return False
+        return self.handler.get("in_progress") == "true"
 
     def check_responded(self):
-        if "response_%s" % self.collection.client.my_shard_id in self.handler:
-            return self.handler["response_%s" % self.collection.client.my_shard_id].decode("utf-8") != ""
-        return True
+        return self.handler.get("response_%s" % self.collection.client.my_shard_id) != ""
 
     def start_query(self, query):
-        if "in_progress" not in self.handler:
+        raw_progress = self.handler.get("in_progress")
+        if raw_progress is None:
             self.handler["in_progress"] = str(True)
         else:
-            raw_progress = self.handler["in_progress"].decode("utf-8")
             # print("RAW IN_PROGRESS: %s | BOOL IN_PROGRESS: %s" % (raw_progress, to_bool(raw_progress)))
 
             if raw_progress == "true":
@@ -590,7 +1977,7 @@ class QueryRedis:
 
     def respond_to_query(self, query=None):
         if query is None:
-            query = self.handler["query"].decode("utf-8")
+            query = self.handler.get("query")
         try:
             response = str(eval(query))
             if response == "": response = "-- EMPTY --"
@@ -603,9 +1990,8 @@ class QueryRedis:
 
     def check_completed(self):
         if not self.query_in_progress(): return False
-        for shard in range(self.collection.client.my_shard_count):
-            if self.handler["response_%s" % shard].decode("utf-8") == "": return False
-        return True
+        responses = self.handler.get_many(["response_%s" % shard for shard in range(self.collection.client.my_shard_count)], "")
+        return all(response != "" for response in responses)
 
     @asyncio.coroutine
     def wait_for_query(self):
@@ -617,7 +2003,7 @@ class QueryRedis:
             asyncio.sleep(0.5)
 
 
-class ShardTrackerRedis:
+class ShardTrackerRedis(RedisHelper):
     def __init__(self, collection):
         self.handler = RedisHandler("shardtrackers", collection.redis_server)
         self.collection = collection
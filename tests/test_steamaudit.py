@@ -0,0 +1,88 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+try:
+    import redis
+    import steamaudit
+except ImportError:
+    redis = None
+
+# the audit counts every key in a namespace, so it runs against its own (empty) database
+TEST_REDIS_DB = int(os.environ.get("STEAM_TEST_REDIS_DB", 15))
+
+
+def connect():
+    """Connects to the local test database, or returns None if redis isn't installed or running"""
+    if redis is None:
+        return None
+    client = redis.StrictRedis(host="localhost", port=6379, db=TEST_REDIS_DB)
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        return None
+    return client
+
+
+class AuditTest(unittest.TestCase):
+    def setUp(self):
+        self.redis = connect()
+        if self.redis is None:
+            self.skipTest("redis isn't reachable on localhost:6379")
+        if self.redis.dbsize() > 0:
+            self.skipTest("redis database %d isn't empty" % TEST_REDIS_DB)
+        self.addCleanup(self.redis.flushdb)
+
+        # old indexed permission lists: ::2 is past the length and ::0 of the channel list has no length at all
+        self.redis.set("permissions::admin::server::1::length", "2")
+        for index in range(3):
+            self.redis.set("permissions::admin::server::1::%d" % index, "perm%d" % index)
+        self.redis.set("permissions::admin::channel::5::0", "perm")
+        self.redis.sadd("permissions::admin::server::2::set", "perm")
+
+        # prefixes which were set back to the default rather than deleted
+        self.redis.set("prefixes::server::1", "!")
+        self.redis.set("prefixes::server::2", "steam ")
+        self.redis.set("prefixes::channel::3", "")
+
+        # one indexed ban set and one the index doesn't know about
+        self.redis.sadd("global_bans::user::1::set", "*")
+        self.redis.sadd("global_bans::user::2::set", "search")
+        self.redis.sadd("global_bans::index::set", "user::1")
+
+        self.redis.set("leftover::1", "x")
+
+    def test_orphaned_permission_indexes(self):
+        result = steamaudit.audit_namespace(self.redis, "permissions", batch_size=2, sample_rate=1)
+        self.assertEqual(result["keys"], 6)
+        self.assertEqual(result["sampled"], 6)
+        self.assertEqual(result["orphans"], 2)
+        self.assertEqual(sorted(result["orphan_examples"]),
+                         ["permissions::admin::channel::5::0", "permissions::admin::server::1::2"])
+
+    def test_default_prefixes(self):
+        result = steamaudit.audit_namespace(self.redis, "prefixes")
+        self.assertEqual(result["keys"], 3)
+        self.assertEqual(result["orphans"], 2)
+        self.assertEqual(sorted(result["orphan_examples"]), ["prefixes::channel::3", "prefixes::server::2"])
+
+    def test_unindexed_bans(self):
+        result = steamaudit.audit_namespace(self.redis, "global_bans")
+        self.assertEqual(result["keys"], 3)
+        self.assertEqual(result["orphans"], 1)
+        self.assertEqual(result["orphan_examples"], ["global_bans::user::2::set"])
+
+    def test_keyspace(self):
+        results = steamaudit.audit_keyspace(self.redis, ["permissions", "prefixes", "global_bans"])
+        by_namespace = {result["namespace"]: result for result in results}
+        self.assertEqual(results[-1]["namespace"], None)
+        self.assertEqual({namespace: result["orphans"] for namespace, result in by_namespace.items()},
+                         {"permissions": 2, "prefixes": 2, "global_bans": 1, None: 1})
+        self.assertEqual(by_namespace[None]["orphan_examples"], ["leftover::1"])
+        self.assertEqual(sum(result["keys"] for result in results), self.redis.dbsize())
+
+
+if __name__ == "__main__":
+    unittest.main()